@@ -6,8 +6,12 @@ from pyftdi.spi import SpiController
 from pyftdi.ftdi import Ftdi
 import ftd2xx
 import time
+import json
 from matplotlib import pyplot as plt
-import pickle
+import mini_uScope_results
+import mini_uScope_analysis
+import mini_uScope_sweep
+import mini_uScope_interfaces
 import numpy
 np = numpy
 
@@ -33,10 +37,23 @@ spi.configure('ftdi://:232h/1')
 slave = spi.get_port(cs=1, freq=1E6, mode=1)
 
 class tx_m():
+	#keeps a shadow copy of the registers written (like rxtx_SPI), so write_regs only sends the ones that change
+	def __init__(self):
+		self.shadow = {}
+
 	def write_reg(self, address, data):
+		if address not in mini_uScope_interfaces.volatile_regs:
+			self.shadow[address] = data
 		data = bytearray([address+64, data])
 		slave.exchange(data, duplex=True)
 
+	def write_regs(self, regs):
+		#{address: value}, skipping registers already holding that value; contiguous ones go as one burst write
+		regs = {a: v for a, v in regs.items() if a in mini_uScope_interfaces.volatile_regs or self.shadow.get(a) != v}
+		for payload in mini_uScope_interfaces.plan_reg_writes(regs, self.shadow):
+			slave.exchange(out=bytearray(payload), readlen=len(payload), duplex=True)
+		self.shadow.update({a: v for a, v in regs.items() if a not in mini_uScope_interfaces.volatile_regs})
+
 	def read_reg(self, address):
 		data = bytearray([address, 0])
 		reg_val = slave.exchange(out=data, readlen=2, duplex=True)
@@ -86,71 +103,60 @@ class tx_m():
 		pulses = [0]*12
 		for indx in list_of_pulses:
 			pulses[indx] = pulse_freq+128+64+32
-		data = [0x10+64+128] + pulses
-		data = bytearray(data)
-		# print(data)
-		n_data = len(data)
-		slave.exchange(out=data, readlen=n_data, duplex=True)
+		self.write_regs({0x10+j: pulses[j] for j in range(12)}) #only the pulses that change, as one burst
 
 
 #=====================================================================RX setup
 
 dev = ftd2xx.open(0) #open device index 0 - should be the only one since other two are set to libusbk drivers
-dev.setBitMode(0x00, 0x00) #reset - ASYNC FIFO is set in EEPROM settings
-dev.setUSBParameters(32768, 32768)
-
-def fifo_rx():
-    buffered = dev.getQueueStatus() #returns number of elements in the queue
-    rx_buffer = dev.read(buffered)
-    return rx_buffer
+#register access over the FIFO channel (replies owed to earlier writes, waiting for a reply) is rx_FIFO's, which also
+#puts the device in async FIFO mode
+fifo = mini_uScope_interfaces.rx_FIFO(dev=dev)
 
 class rx_m():
+	#the reciever's registers, through fifo; adds a shadow copy of the registers written, as in tx_m
+	def __init__(self):
+		self.shadow = {}
+
+	def drain(self):
+		fifo.drain()
+
 	def write_reg(self, address, data):
-		data = bytes([2, address+64, data])
-		dev.write(data)
+		if address not in mini_uScope_interfaces.volatile_regs:
+			self.shadow[address] = data
+		fifo.write_reg(address, data)
+
+	def write_regs(self, regs):
+		#{address: value}, skipping registers already holding that value; contiguous ones go as one burst write
+		regs = {a: v for a, v in regs.items() if a in mini_uScope_interfaces.volatile_regs or self.shadow.get(a) != v}
+		for payload in mini_uScope_interfaces.plan_reg_writes(regs, self.shadow):
+			dev.write(bytes([0]*20 + [len(payload)] + payload)) #some buffer (leading zeros), then transaction size, then the transaction
+			fifo.pending = fifo.pending + len(payload)
+		self.shadow.update({a: v for a, v in regs.items() if a not in mini_uScope_interfaces.volatile_regs})
 
 	def read_reg(self, address):
-		time.sleep(0.05)
-		fifo_rx() #clear rx buffer
-		data = bytes([2, address, 0])
-		# data = bytes(20*[0])
-		dev.write(data)
-		time.sleep(0.05)
-		reg_val = fifo_rx()
-		reg_val = [int(val) for val in reg_val]
-		# print(reg_val)
-		if len(reg_val) < 1:
-			return -1
-		else:
-			return int(reg_val[-1])
+		return fifo.read_reg(address) #-1 if no reply
+
+	def burst_read(self, address, n):
+		#reads n bytes starting at address in one transaction, e.g. to empty the UWB RX FIFO (0x3F) in one go
+		return fifo.burst_read(address, n)
 
 	def read_data(self):
-		reg_val = fifo_rx() #If data is there, should just appear!
-		reg_val = [int(i) for i in reg_val] #convert from byte array to list of ints
-		return reg_val
+		return fifo.read_data() #If data is there, should just appear!  Raw bytes; analysis converts whole captures to numpy at once
 
 	def config_pulses(self, list_of_pulses, pulse_freq):
 		#do a bulk write of the twelve pulse-parameter registers
 		pulses = [0]*12
 		for indx in list_of_pulses:
 			pulses[indx] = pulse_freq+128+64+32
-		data = [0]*20 + [13] + [0x10+64+128] + pulses #some buffer (leading zeros), then transaction size, command byte, then pulse data
-		data = bytes(data)
-		dev.write(data)
+		self.write_regs({0x10+j: pulses[j] for j in range(12)}) #only the pulses that change, as one burst
 
 		#flush returned values from buffer:
-		time.sleep(0.05)
-		fifo_rx()
+		self.drain()
 
 
 	def read_status(self):
-		time.sleep(0.05)
-		fifo_rx() #clear rx buffer
-		data = bytes([2, 0, 0, 2, 0, 0])
-		dev.write(data)
-		time.sleep(0.05)
-		reg_val = fifo_rx()
-		return (int(reg_val[0]), int(reg_val[2]))
+		return fifo.read_status()
 
 	def config(self):
 		self.write_reg(4, 0) #set device to only return to IDLE state between packets, rather than returning to a lower & slower power mode, and to do so at the end of every transmission
@@ -172,12 +178,6 @@ class rx_m():
 		for j in range(4):
 			self.write_reg(0x11+j, filt_val+224) #transmitted pulse center frequency
 
-def binary_majority_vote(x):
-	count1 = 0
-	for i in range(8):
-		count1 = count1 + (x >> i)%2
-	return 1*(count1 > 4)
-
 tx = tx_m()
 rx = rx_m()
 
@@ -187,144 +187,136 @@ rx.config()
 # print(rx.read_reg(0x1F))
 # print(tx.read_reg(0x1F))
 
-quality_list  =[]
-
-for rx_filt_freq in range(23, 27):
-	for pulse_freq in range(23, 27):
-		for pulse_config_indx in range(64):
-
-			# print("Pulse position: %i"%pulse_config_indx)
-			pulse_config = []
-			for j in range(12): #expand to one-hot
-				if (pulse_config_indx >> j)%2 == 1:
-					pulse_config.append(j)
-			if len(pulse_config) < 5:
-				continue
-			# print([pulse_config])
-			# pulse_config = [1,2,3,4]
-			tx.config_pulses(pulse_config, pulse_freq)
-			rx.config_pulses(pulse_config, pulse_freq)
-			LNA_val = 4
-			rx.write_reg(0x0F, LNA_val*32+rx_filt_freq)
-			# rx.config_pulses([1,2,3,4], 25)
-
-			dropped_packets = 0.
-			wrong_packets = 0.
-			errors = 0.
-			packet_size = 64
-			npackets = 1024
-			i = 0
-			recieved_data = []
-			transmitted_data = []
-			# while (i < npackets):
-			tx.write_reg(0x1F, 16)
-			time.sleep(0.0001)
-			tx.write_reg(0x1F, 16)
-			time.sleep(0.2) #make sure interface is cleared before starting
-			rx.read_data()
-			for i in range(npackets):
-				#check: if system is performing well, extend the experiment to more packets
-				# if i == (npackets-2) and dropped_packets < 10 and npackets < 1e6:
-					# npackets = npackets*2
-
-				print("packet %i"%i, end="\r")
-				rnd_data = numpy.random.randint(0, 256, size=[packet_size], dtype=np.ubyte)
-				# rnd_data[0] = 255*(i%2) #alternate between leading each packet with zero and leading each packet with 255
-				rnd_data = [val for val in rnd_data]
-				transmitted_data = transmitted_data + rnd_data
-				# tx.write_data(rnd_data)
-				# tx.write_reg(0x1F, 16) #set device to transmitter mode, and send a start transmission command
-				# time.sleep(0.0001)
-				# tx.write_reg(0x1F, 16)
-				 #set device to transmitter mode, and send a start transmission command
-				# print(tx.read_reg(1))
-				# print(tx.read_reg(0))
-				# print(tx.read_reg(2))
-				# n_rx = rx.read_reg(3) #reads number of bytes in RX FIFO
-				# rssi = rx.read_reg(0x22)
-				# if n_rx > 16:
-				# time.sleep(0.0001)
-				# return_data = []
-				# for wait in range(1000):
-				recieved_data = recieved_data + rx.read_data()
-					# if len(return_data) >= packet_size:
-						# break
-				# n_rx = len(return_data)
-				# return_data = [int(val) for val in return_data]
-				# rssi = -1
-				# if (n_rx == 0):
-				# 	dropped_packets = dropped_packets + 1
-				# if n_rx != packet_size:
-				# 	wrong_packets = wrong_packets + 1
-				
-				# if n_rx == packet_size:
-				# 	errors = errors + np.sum(1-1*((np.array(rnd_data)-np.array(return_data)) == 0))
-
-				# print(rnd_data)
-				# print(return_data)
-				# print("")
-				# i = i + 1
-
-			time.sleep(0.2) #make sure every last bit of info makes it through the USB interface:
-			recieved_data = recieved_data + rx.read_data()
-
-			#break it into packets, check headers, etc
-			recieved_amnt = len(recieved_data)/len(transmitted_data)
-			# print(transmitted_data[:20])
-			# print(recieved_data[:20])
-			if (len(recieved_data)%packet_size == 0 and len(recieved_data) > 0):
-				drop_rate = (len(transmitted_data)-len(recieved_data))/len(transmitted_data)
-				recieved_data = numpy.reshape(recieved_data, [-1,packet_size])
-				transmitted_data = numpy.reshape(transmitted_data, [-1,packet_size])
-				# print(recieved_data.shape)
-				if drop_rate == 0:
-					ber = np.sum(1-1*((transmitted_data-recieved_data) == 0))/(transmitted_data.shape[0]*transmitted_data.shape[1])/8.
-				else:
-					#iterate through packets.  Assume at most 1 dropped packet in a row
-					errors = 0
-					rx_index = 0
-					for tx_index in range(npackets):
-
-						if rx_index == recieved_data.shape[1]:
-							break #if rx is shorter, may need to break early
-
-						#have to interpret first byte as all ones or all zeros, but there might be bit errors... majority vote
-						new_errors  = np.sum(1.-1.*((transmitted_data[tx_index,:]-recieved_data[rx_index,:]) == 0))
-						# print(transmitted_data[:,tx_index])
-						# print(recieved_data[:,rx_index])
-						# print(packet_size*0.9)
-						if new_errors > packet_size*0.9:
-							continue #assume this is the wrong packet
-						# if binary_majority_vote(recieved_data[0,rx_index]) != binary_majority_vote(transmitted_data[0,tx_index]):
-							# continue #don't incriment rx_index, assuming that a packet is missing in rx, then tx needs to incriment to catch up
-						#otherwise, assume we are matching the correct packets
-						errors = errors + new_errors
-						rx_index = rx_index + 1
-						
-					# print(rx_index/tx_index)
-
-					ber = errors / (recieved_data.shape[0]*recieved_data.shape[1]) / 8.
-					if rx_index != recieved_data.shape[1]:
-						ber = -1.
-			elif len(recieved_data)%packet_size != 0:
-				print("Error! Data not a mutliple of 64 bytes!")
-				drop_rate = 1;
-				ber = 1;
-			else:
-				drop_rate = 1;
-				ber = 1;
-
-
-				
-			rssi = rx.read_reg(0x22)
-			rnsi = rx.read_reg(0x23)
-
-			print("Dropped packet rate: %.4f, bit error rate: %.4f, recieved amount: %.4f, RSSI: %i, RNSI: %i"%(drop_rate, ber, recieved_amnt, rssi, rnsi))
-
-			quality_list.append([pulse_config, pulse_freq, rx_filt_freq, drop_rate, ber, rssi, rnsi])
-
-
-#finally, when done, need to plot historgrams and save result lists to a pickle
-
-with open('quality_results.pkl', 'wb') as f:
-	pickle.dump(quality_list, f)
\ No newline at end of file
+quality_results = mini_uScope_results.result_store('quality_results') #each point is appended to disk as soon as it is measured
+#where in the packet the bit errors of each point fall (mini_uScope_analysis.error_profile), one JSON line per point
+profile_log = open('quality_profiles.jsonl', 'a')
+
+def measure(LNA_val, rx_filt_freq, pulse_freq, pulse_config):
+	time_start = time.time()
+	tx.config_pulses(pulse_config, pulse_freq)
+	rx.config_pulses(pulse_config, pulse_freq)
+	rx.write_regs({0x0F: LNA_val*32+rx_filt_freq})
+	# rx.config_pulses([1,2,3,4], 25)
+
+	dropped_packets = 0.
+	wrong_packets = 0.
+	errors = 0.
+	packet_size = 64
+	npackets = 1024
+	i = 0
+	recieved_data = []
+	transmitted_data = []
+	# while (i < npackets):
+	tx.write_reg(0x1F, 16)
+	time.sleep(0.0001)
+	tx.write_reg(0x1F, 16)
+	time.sleep(0.2) #make sure interface is cleared before starting
+	rx.read_data()
+	estimator = mini_uScope_analysis.link_estimator(target_BER=1e-3, target_PER=0.05)
+	counted = [0, 0, 0, 0] #bits, bit errors, packets sent and dropped already added to the estimator
+	for i in range(npackets):
+		#check: if system is performing well, extend the experiment to more packets
+		# if i == (npackets-2) and dropped_packets < 10 and npackets < 1e6:
+			# npackets = npackets*2
+
+		print("packet %i"%i, end="\r")
+		rnd_data = numpy.random.randint(0, 256, size=[packet_size], dtype=np.ubyte)
+		# rnd_data[0] = 255*(i%2) #alternate between leading each packet with zero and leading each packet with 255
+		transmitted_data.append(rnd_data)
+		# tx.write_data(rnd_data)
+		# tx.write_reg(0x1F, 16) #set device to transmitter mode, and send a start transmission command
+		# time.sleep(0.0001)
+		# tx.write_reg(0x1F, 16)
+		 #set device to transmitter mode, and send a start transmission command
+		# print(tx.read_reg(1))
+		# print(tx.read_reg(0))
+		# print(tx.read_reg(2))
+		# n_rx = rx.read_reg(3) #reads number of bytes in RX FIFO
+		# rssi = rx.read_reg(0x22)
+		# if n_rx > 16:
+		# time.sleep(0.0001)
+		# return_data = []
+		# for wait in range(1000):
+		recieved_data.append(rx.read_data())
+			# if len(return_data) >= packet_size:
+				# break
+		# n_rx = len(return_data)
+		# return_data = [int(val) for val in return_data]
+		# rssi = -1
+		# if (n_rx == 0):
+		# 	dropped_packets = dropped_packets + 1
+		# if n_rx != packet_size:
+		# 	wrong_packets = wrong_packets + 1
+		
+		# if n_rx == packet_size:
+		# 	errors = errors + np.sum(1-1*((np.array(rnd_data)-np.array(return_data)) == 0))
+
+		# print(rnd_data)
+		# print(return_data)
+		# print("")
+		# i = i + 1
+
+		#every 128 packets, see if the answer is already clear.  The last few packets sent may still be on their way,
+		#so they are left out of the check rather than counted as dropped; the ones of them that did arrive just don't
+		#match anything.  The estimator gets what changed since the last check
+		if i % 128 == 127:
+			so_far = mini_uScope_analysis.link_errors(numpy.concatenate(transmitted_data[:-16]), bytes().join(recieved_data), packet_size)
+			counts = [so_far['matched']*packet_size*8, so_far['bit_errors'], so_far['packets_sent'], so_far['dropped']]
+			estimator.add(*[new - old for new, old in zip(counts, counted)])
+			counted = counts
+			if estimator.status() != 'pending':
+				print("stopping after %i packets: %s"%(i+1, estimator.status()))
+				break
+
+	time.sleep(0.2) #make sure every last bit of info makes it through the USB interface:
+	recieved_data.append(rx.read_data())
+	recieved_data = numpy.frombuffer(bytes().join(recieved_data), dtype=np.ubyte)
+	transmitted_data = numpy.concatenate(transmitted_data)
+
+	#break it into packets, check headers, etc
+	recieved_amnt = len(recieved_data)/len(transmitted_data)
+	# print(transmitted_data[:20])
+	# print(recieved_data[:20])
+	if (len(recieved_data)%packet_size == 0 and len(recieved_data) > 0):
+		#match received packets to transmitted ones (tolerates dropped packets) and count actual bit errors
+		profile = mini_uScope_analysis.error_profile(packet_size)
+		link = mini_uScope_analysis.link_errors(transmitted_data, recieved_data, packet_size, profile=profile)
+		drop_rate = link['PER']
+		ber = link['BER']
+		print(profile.summary())
+		profile_result = {name: value.tolist() if hasattr(value, 'tolist') else value for name, value in profile.result().items()}
+		profile_log.write(json.dumps(dict(profile_result, LNA=LNA_val, filt_freq=rx_filt_freq, pulse_freq=pulse_freq, pulse_config=pulse_config, time=time_start)) + "\n")
+		profile_log.flush()
+	elif len(recieved_data)%packet_size != 0:
+		print("Error! Data not a mutliple of 64 bytes!")
+		drop_rate = 1;
+		ber = 1;
+	else:
+		drop_rate = 1;
+		ber = 1;
+
+
+		
+	rssi = rx.read_reg(0x22)
+	rnsi = rx.read_reg(0x23)
+
+	print("Dropped packet rate: %.4f, bit error rate: %.4f, recieved amount: %.4f, RSSI: %i, RNSI: %i"%(drop_rate, ber, recieved_amnt, rssi, rnsi))
+
+	return {'LNA': LNA_val, 'filt_freq': rx_filt_freq, 'pulse_freq': pulse_freq, 'pulse_config': pulse_config,
+	        'BER': ber, 'PER': drop_rate, 'RSSI': rssi, 'RNSI': rnsi, 'time_start': time_start, 'time_end': time.time()}
+
+
+#every point with at least 5 of the first 6 pulses on.  Each result is appended to the store as soon as it is measured,
+#and if the script is restarted after a crash, points already in the store are skipped.  Measured in plan_order, so
+#consecutive points differ in as few registers as possible, and tx_m/rx_m.write_regs only write those
+points = [(4, rx_filt_freq, pulse_freq, mask) for rx_filt_freq in range(23, 27) for pulse_freq in range(23, 27) for mask in range(64) if mini_uScope_sweep.popcount(mask) >= 5]
+points = mini_uScope_sweep.plan_order(points)
+runner = mini_uScope_sweep.sweep_runner(quality_results, measure, settings={'script': 'FTDI SR10x0 test', 'npackets': 1024, 'packet_size': 64, 'targets': [1e-3, 0.05]})
+for point, result in runner.run(points):
+	pass
+print("%i points measured, %i already done"%(runner.measured, runner.resumed))
+
+
+#finally, when done, need to plot historgrams
+quality_results.close()
+profile_log.close()
\ No newline at end of file
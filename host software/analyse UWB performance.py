@@ -1,21 +1,22 @@
-import pickle
+import os
+import mini_uScope_results
 from matplotlib import pyplot as plt
 from matplotlib.widgets import Button
 from matplotlib.text import Annotation
 
 
-with open('quality_results_first_6_pulses.pkl', 'rb') as f:
-	results = pickle.load(f)
+#results are kept in a columnar store; old pickled lists are imported into one the first time round
+if not os.path.exists('quality_results_first_6_pulses'):
+	mini_uScope_results.import_pickle('quality_results_first_6_pulses.pkl', mini_uScope_results.result_store('quality_results_first_6_pulses'))
+results = mini_uScope_results.result_store('quality_results_first_6_pulses')
 
-drop_rate = []
-ber = []
+drop_rate = results.column('PER')
+ber = results.column('BER')
 labels = []
 
-for result in results:
-	drop_rate.append(result[3])
-	ber.append(result[5]/8.)
+for result in results.records():
 	#annotation string:
-	labels.append(str(result))
+	labels.append("pulses %s, pulse freq %i, filt freq %i, PER %.4f, BER %.5f"%(mini_uScope_results.pulse_list(result['pulse_config']), result['pulse_freq'], result['filt_freq'], result['PER'], result['BER']))
 
 # plt.figure()
 # plt.scatter(ber, drop_rate)
@@ -8,6 +8,7 @@ import ftd2xx
 import time
 from matplotlib import pyplot as plt
 import numpy
+import mini_uScope_interfaces
 np = numpy
 
 #============================================================TX setup
@@ -59,36 +60,24 @@ class tx_m():
 #=====================================================================RX setup
 
 dev = ftd2xx.open(0) #open device index 0 - should be the only one since other two are set to libusbk drivers
-dev.setBitMode(0x00, 0x00) #reset - ASYNC FIFO is set in EEPROM settings
-dev.setUSBParameters(32768, 32768)
-
-def fifo_rx():
-    buffered = dev.getQueueStatus() #returns number of elements in the queue
-    rx_buffer = dev.read(buffered)
-    return rx_buffer
+#register access over the FIFO channel (replies owed to earlier writes, waiting for a reply) is rx_FIFO's, which also
+#puts the device in async FIFO mode
+fifo = mini_uScope_interfaces.rx_FIFO(dev=dev)
 
 class rx_m():
+	#the reciever's registers, through fifo
 	def write_reg(self, address, data):
-		data = bytes([2, address+64, data])
-		dev.write(data)
+		fifo.write_reg(address, data)
 
 	def read_reg(self, address):
-		time.sleep(0.05)
-		fifo_rx() #clear rx buffer
-		data = bytes([2, address, 0])
-		dev.write(data)
-		time.sleep(0.05)
-		reg_val = fifo_rx()
-		return int(reg_val[1])
+		return fifo.read_reg(address) #-1 if no reply
+
+	def burst_read(self, address, n):
+		#reads n bytes starting at address in one transaction, e.g. to empty the UWB RX FIFO (0x3F) in one go
+		return fifo.burst_read(address, n)
 
 	def read_status(self):
-		time.sleep(0.05)
-		fifo_rx() #clear rx buffer
-		data = bytes([2, 0, 0, 2, 0, 0])
-		dev.write(data)
-		time.sleep(0.05)
-		reg_val = fifo_rx()
-		return (int(reg_val[0]), int(reg_val[2]))
+		return fifo.read_status()
 
 	def config(self):
 		self.write_reg(4, 0) #set device to only return to IDLE state between packets, rather than returning to a lower & slower power mode
@@ -131,8 +120,8 @@ for i in range(256):
 	# print(rx.read_status())
 	n_rx = rx.read_reg(3) #reads number of bytes in RX FIFO
 	print("recieved %i bytes"%n_rx)
-	for j in range(n_rx): #clear reading buffer
-		rx.read_reg(0x3F)
+	if n_rx > 0: #clear reading buffer
+		rx.burst_read(0x3F, n_rx)
 	if n_rx > 0:
 		rssi = rx.read_reg(0x22)
 		rssi_values[lna_val, filt_val] = rssi
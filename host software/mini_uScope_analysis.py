@@ -0,0 +1,351 @@
+import math
+import numpy
+import mini_uScope_interfaces
+import mini_uScope_reconstruction
+
+#============================================================
+#link quality analysis: bit and packet error rates from transmitted vs received packets.
+#everything works on whole numpy arrays of packets ([npackets, packet_size] uint8), so sweeps over millions of
+#packets don't go through a python loop per packet.
+
+def packet_rows(data, packet_size=64):
+	#bytes, bytearray, list of ints or a numpy array -> [npackets, packet_size] uint8 array (trailing partial packet dropped)
+	if isinstance(data, (bytes, bytearray, memoryview)):
+		data = numpy.frombuffer(data, dtype=numpy.uint8)
+	data = numpy.asarray(data, dtype=numpy.uint8)
+	if data.ndim == 2:
+		return data
+	npackets = len(data)//packet_size
+	return data[:npackets*packet_size].reshape([npackets, packet_size])
+
+popcount_table = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8) #set bits of every byte value
+
+def count_bit_errors(a, b, chunk=65536):
+	#exact number of differing bits between two equally shaped packet arrays.  Errors are rare, so only the packets that
+	#differ at all go through the popcount table
+	errors = 0
+	for i in range(0, len(a), chunk):
+		x = a[i:i+chunk] ^ b[i:i+chunk]
+		x = x[x.any(axis=1)] if x.ndim == 2 else x
+		errors = errors + int(popcount_table[x].sum(dtype=numpy.int64))
+	return errors
+
+def packet_hashes(packets):
+	#64 bit hash of each packet, mixing its bytes 8 at a time
+	packets = numpy.ascontiguousarray(packets)
+	if packets.shape[1] % 8 != 0:
+		packets = numpy.pad(packets, [(0, 0), (0, 8 - packets.shape[1] % 8)])
+	words = packets.view(numpy.uint64)
+	h = numpy.zeros(len(packets), dtype=numpy.uint64)
+	for i in range(words.shape[1]):
+		h = (h ^ words[:, i])*numpy.uint64(0x100000001B3)
+		h = h ^ (h >> numpy.uint64(29))
+	return h
+
+def exact_matches(transmitted, received):
+	#index of the transmitted packet that each received packet is an exact copy of, or -1.
+	#packets are hashed, so this is one sort and one search rather than a loop; hash hits are then checked byte for byte.
+	#packets that were transmitted more than once are ambiguous and don't count as a match.
+	tx_keys = packet_hashes(transmitted)
+	rx_keys = packet_hashes(received)
+	order = numpy.argsort(tx_keys)
+	tx_sorted = tx_keys[order]
+	pos = numpy.minimum(numpy.searchsorted(tx_sorted, rx_keys), len(tx_sorted) - 1)
+	found = tx_sorted[pos] == rx_keys
+	nxt = numpy.minimum(pos + 1, len(tx_sorted) - 1)
+	found = found & ((nxt == pos) | (tx_sorted[nxt] != rx_keys))
+	index = numpy.where(found, order[pos], -1)
+	hit = numpy.flatnonzero(found)
+	same = numpy.all(transmitted[index[hit]] == received[hit], axis=1)
+	index[hit[~same]] = -1
+	return index
+
+def match_packets(transmitted, received, window=8, max_errors=None, chunk=16384):
+	#works out which transmitted packet each received packet is, tolerating dropped packets.
+	#error-free packets are matched exactly (exact_matches) and act as anchors; every other received packet is compared
+	#against a small band of candidates - from the drop count of the anchor before it, up to window more drops, but no
+	#further than the anchor after it allows - and takes the closest one.
+	#returns the transmitted index for each received packet, -1 where nothing is close (more than max_errors bytes wrong)
+	ntx = len(transmitted)
+	nrx = len(received)
+	if max_errors is None:
+		max_errors = int(transmitted.shape[1]*0.9) #same threshold as the old per-packet loop
+	tx_index = numpy.full(nrx, -1, dtype=numpy.int64)
+	if ntx == 0 or nrx == 0:
+		return tx_index
+
+	#offset of each anchor = packets dropped before it, less any stray packets received before it.  Packets arrive in
+	#the order they were sent, so an anchor that doesn't come after every earlier anchor is a repeat of a packet that
+	#already arrived, and is thrown out
+	anchor = exact_matches(transmitted, received)
+	anchored = numpy.flatnonzero(anchor >= 0)
+	tx_anchor = anchor[anchored]
+	consistent = tx_anchor > numpy.maximum.accumulate(numpy.append(-1, tx_anchor[:-1]))
+	anchored = anchored[consistent]
+	offset = tx_anchor[consistent] - anchored
+	tx_index[anchored] = anchored + offset
+
+	#band limits for everything else, from the nearest anchors on either side.  Past the last anchor the band is only
+	#limited by the end of the transmitted packets (candidate < ntx below): the number of received packets says nothing
+	#about the drops, since stray or duplicated packets can arrive as well
+	last = numpy.full(nrx, -1)
+	last[anchored] = numpy.arange(len(anchored))
+	last = numpy.maximum.accumulate(last)
+	after = numpy.full(nrx, len(anchored))
+	after[anchored] = numpy.arange(len(anchored))
+	after = numpy.minimum.accumulate(after[::-1])[::-1]
+	padded = numpy.append(offset, 0) #so there is something to index when nothing was anchored
+	lo = numpy.where(last >= 0, padded[numpy.maximum(last, 0)], 0)
+	hi = numpy.where(after < len(anchored), padded[numpy.minimum(after, len(anchored))], ntx - 1 - numpy.arange(nrx))
+	lo = numpy.minimum(lo, hi) #strays between two anchors leave the later one at a smaller offset
+
+	todo = numpy.flatnonzero(tx_index < 0)
+	steps = numpy.arange(window + 1)
+	for i in range(0, len(todo), chunk):
+		j = todo[i:i+chunk]
+		candidate_offset = lo[j, None] + steps[None, :]
+		candidate = j[:, None] + candidate_offset
+		valid = (candidate_offset <= hi[j, None]) & (candidate >= 0) & (candidate < ntx)
+		candidate = numpy.clip(candidate, 0, ntx - 1)
+		errors = numpy.sum(transmitted[candidate] != received[j, None, :], axis=2)
+		errors[~valid] = transmitted.shape[1] + 1
+		best = numpy.argmin(errors, axis=1)
+		best_errors = errors[numpy.arange(len(j)), best]
+		tx_index[j] = numpy.where(best_errors <= max_errors, candidate[numpy.arange(len(j)), best], -1)
+	return tx_index
+
+#============================================================
+#where the bit errors are: which byte of the packet and which bit of the byte they hit, how many each damaged packet
+#has, and how long the bursts of consecutive wrong bits are - to tell errors at the timer header or the packet edges,
+#or errors that come in bursts, from ones spread evenly over the packet.  Only the packets with errors are unpacked to
+#bits, so a profile of millions of packets takes about as long as counting the errors.
+
+class error_profile():
+	#bit positions are in unpackbits order: bit 0 is the most significant bit of byte 0
+	def __init__(self, packet_size=64):
+		self.packet_size = packet_size
+		self.packets = 0
+		self.errored_packets = 0
+		self.bit_errors = 0
+		self.compared = numpy.zeros(packet_size, dtype=numpy.int64) #number of times each byte offset was compared
+		self.by_position = numpy.zeros(packet_size*8, dtype=numpy.int64) #errors at each bit of the packet
+		self.errors_per_packet = numpy.zeros(packet_size*8 + 1, dtype=numpy.int64) #histogram: packets with n bit errors
+		self.burst_lengths = numpy.zeros(packet_size*8 + 1, dtype=numpy.int64) #histogram: bursts of n wrong bits in a row
+
+	def add(self, expected, received, offset=0, chunk=65536):
+		#expected/received: [npackets, width] uint8 (or broadcastable), the bytes at offset..offset+width of each packet,
+		#e.g. only the payload with offset=4
+		received = packet_rows(received, self.packet_size)
+		expected = numpy.broadcast_to(numpy.asarray(expected, dtype=numpy.uint8), received.shape)
+		width = received.shape[1]
+		for i in range(0, len(received), chunk):
+			x = expected[i:i+chunk] ^ received[i:i+chunk]
+			x = x[x.any(axis=1)]
+			counts = popcount_table[x].sum(axis=1, dtype=numpy.int64)
+			self.errors_per_packet[0] = self.errors_per_packet[0] + len(received[i:i+chunk]) - len(x)
+			self.errors_per_packet[:width*8+1] += numpy.bincount(counts, minlength=width*8+1)[:width*8+1]
+			self.errored_packets = self.errored_packets + len(x)
+			self.bit_errors = self.bit_errors + int(counts.sum())
+			if len(x) == 0:
+				continue
+			bits = numpy.unpackbits(x, axis=1)
+			self.by_position[offset*8:(offset+width)*8] += bits.sum(axis=0, dtype=numpy.int64)
+
+			#bursts: runs of ones in each packet's bits, with a zero either side so runs never join across packets
+			padded = numpy.zeros([len(bits), bits.shape[1] + 2], dtype=numpy.int8)
+			padded[:, 1:-1] = bits
+			edges = numpy.diff(padded, axis=1).ravel()
+			lengths = numpy.flatnonzero(edges == -1) - numpy.flatnonzero(edges == 1)
+			self.burst_lengths += numpy.bincount(lengths, minlength=len(self.burst_lengths))[:len(self.burst_lengths)]
+		self.packets = self.packets + len(received)
+		self.compared[offset:offset+width] += len(received)
+
+	def merge(self, other):
+		#adds another profile's counts (e.g. from another process or another capture of the same point)
+		for name in ['packets', 'errored_packets', 'bit_errors']:
+			setattr(self, name, getattr(self, name) + getattr(other, name))
+		for name in ['compared', 'by_position', 'errors_per_packet', 'burst_lengths']:
+			getattr(self, name)[:] += getattr(other, name)
+
+	def bits(self):
+		return int(self.compared.sum())*8
+
+	def BER(self, start=0, stop=None):
+		#bit error rate over bytes start..stop of the packet
+		errors = self.by_position[start*8:None if stop is None else stop*8].sum()
+		bits = self.compared[start:stop].sum()*8
+		return errors/bits if bits > 0 else 0.
+
+	def result(self):
+		by_byte = self.by_position.reshape([self.packet_size, 8]).sum(axis=1)
+		by_bit = self.by_position.reshape([self.packet_size, 8]).sum(axis=0)
+		nbursts = int(self.burst_lengths.sum())
+		result = {}
+		result['packets'] = self.packets
+		result['errored_packets'] = self.errored_packets
+		result['bit_errors'] = self.bit_errors
+		result['BER'] = self.bit_errors/self.bits() if self.bits() > 0 else 0.
+		result['header_BER'] = self.BER(0, 4) #the timer header
+		result['payload_BER'] = self.BER(4)
+		result['edge_BER'] = (by_byte[[0, -1]].sum())/(self.compared[[0, -1]].sum()*8) if self.compared[[0, -1]].sum() > 0 else 0.
+		result['byte_BER'] = numpy.where(self.compared > 0, by_byte/numpy.maximum(self.compared*8, 1), 0.)
+		result['bit_BER'] = by_bit/self.bits()*8 if self.bits() > 0 else numpy.zeros(8)
+		result['errors_per_packet'] = self.errors_per_packet[:numpy.flatnonzero(self.errors_per_packet)[-1] + 1] if self.packets > 0 else self.errors_per_packet[:1]
+		result['bursts'] = nbursts
+		result['mean_burst'] = float(numpy.dot(numpy.arange(len(self.burst_lengths)), self.burst_lengths))/nbursts if nbursts > 0 else 0.
+		result['max_burst'] = int(numpy.flatnonzero(self.burst_lengths)[-1]) if nbursts > 0 else 0
+		result['burst_fraction'] = 1. - self.burst_lengths[1]/self.bit_errors if self.bit_errors > 0 else 0. #errors that are part of a burst of 2 or more
+		return result
+
+	def summary(self):
+		result = self.result()
+		worst = numpy.argsort(result['byte_BER'])[::-1][:3]
+		return "BER %.2e (header %.2e, payload %.2e, edges %.2e), %i/%i packets with errors, bursts: mean %.2f max %i bits, worst bytes %s"%(
+			result['BER'], result['header_BER'], result['payload_BER'], result['edge_BER'], result['errored_packets'], result['packets'], result['mean_burst'], result['max_burst'], [int(b) for b in worst])
+
+
+def link_errors(transmitted, received, packet_size=64, window=8, profile=None):
+	#BER and PER of a capture.  BER counts actual bit errors (not mismatched bytes/8) over the packets that arrived;
+	#PER is the fraction of transmitted packets that never showed up.  profile: an error_profile to add the matched
+	#packets to
+	transmitted = packet_rows(transmitted, packet_size)
+	received = packet_rows(received, packet_size)
+	tx_index = match_packets(transmitted, received, window)
+	matched = tx_index >= 0
+	nmatched = int(numpy.count_nonzero(matched))
+	bit_errors = count_bit_errors(transmitted[tx_index[matched]], received[matched])
+	if profile is not None:
+		profile.add(transmitted[tx_index[matched]], received[matched])
+
+	result = {}
+	result['packets_sent'] = len(transmitted)
+	result['packets_received'] = len(received)
+	result['matched'] = nmatched
+	result['dropped'] = len(transmitted) - len(numpy.unique(tx_index[matched]))
+	result['unmatched'] = len(received) - nmatched #received packets too damaged to recognise
+	result['bit_errors'] = bit_errors
+	result['BER'] = bit_errors/(nmatched*packet_size*8.) if nmatched > 0 else 1.
+	result['PER'] = result['dropped']/len(transmitted) if len(transmitted) > 0 else 1.
+	result['tx_index'] = tx_index
+	return result
+
+
+#============================================================
+#online estimates: BER and PER updated as packets arrive, with confidence intervals, so a measurement can stop as soon
+#as the link is clearly good or clearly bad instead of running for a fixed time.
+
+def wilson_interval(k, n, z=2.58):
+	#confidence interval for a proportion of k events in n trials (z=2.58 -> 99%).  Unlike p +- z*sigma it stays
+	#sensible at k=0, which is the usual case for a good link
+	if n == 0:
+		return (0., 1.)
+	p = k/n
+	denominator = 1 + z*z/n
+	centre = (p + z*z/(2*n))/denominator
+	half_width = z*math.sqrt(p*(1 - p)/n + z*z/(4*n*n))/denominator
+	return (max(centre - half_width, 0.), min(centre + half_width, 1.))
+
+class link_estimator():
+	#status() is 'accept' once the upper bounds of both BER and PER are below their targets (and at least min_packets have
+	#been seen), 'reject' once the lower bound of either is above its reject threshold (the target, unless given), and
+	#'pending' until then.
+	#counts come in either through add(), or as framed packets of the FPGA test stream through update()/feed(), which
+	#compare the payload against expected_payload and count lost packets exactly from the header timers
+	#(mini_uScope_reconstruction.packet_gaps).
+	#bits within a packet are treated as independent, which makes the BER interval somewhat optimistic for bursty errors
+	def __init__(self, target_BER=1e-3, reject_BER=None, target_PER=0.05, reject_PER=None, z=2.58, min_packets=64, expected_payload=None, periodX=996, periodY=1000, clocks_per_packet=256, profile=None):
+		self.target_BER = target_BER
+		self.reject_BER = reject_BER if reject_BER is not None else target_BER
+		self.target_PER = target_PER
+		self.reject_PER = reject_PER if reject_PER is not None else target_PER
+		self.z = z
+		self.min_packets = min_packets
+		if expected_payload is None:
+			expected_payload = numpy.arange(4, 64, dtype=numpy.uint8) #the FPGA's test pattern
+		self.expected_payload = numpy.asarray(expected_payload, dtype=numpy.uint8)
+		self.periodX = periodX
+		self.periodY = periodY
+		self.clocks_per_packet = clocks_per_packet
+		self.framer = mini_uScope_interfaces.packet_framer(periodX, periodY, clocks_per_packet)
+		self.profile = profile #optional error_profile, gets the payload of every packet through update()
+
+		self.bits = 0
+		self.bit_errors = 0
+		self.packets = 0 #packets sent, as far as we can tell: received + lost
+		self.lost = 0
+		self.prev = None #last trusted header, to count the gap to the next chunk of packets (see packet_gaps)
+		self.gap_histogram = numpy.zeros(1, dtype=numpy.int64) #gap_histogram[n]: number of times n packets in a row were lost
+
+	def add(self, bits=0, bit_errors=0, packets=0, lost=0):
+		self.bits = self.bits + bits
+		self.bit_errors = self.bit_errors + bit_errors
+		self.packets = self.packets + packets
+		self.lost = self.lost + lost
+
+	def update(self, packets):
+		#packets: structured array (mini_uScope_interfaces.packet_dtype), in arrival order
+		if len(packets) == 0:
+			return self.status()
+		payload = packets['payload']
+		bit_errors = count_bit_errors(payload, numpy.broadcast_to(self.expected_payload, payload.shape))
+		if self.profile is not None:
+			self.profile.add(self.expected_payload, payload, offset=mini_uScope_interfaces.packet_size - payload.shape[1])
+
+		gaps = mini_uScope_reconstruction.packet_gaps(packets['timerX'], packets['timerY'], self.periodX, self.periodY, self.clocks_per_packet, prev=self.prev)
+		self.prev = gaps['prev']
+		histogram = gaps['histogram']
+		if len(histogram) > len(self.gap_histogram):
+			self.gap_histogram = numpy.pad(self.gap_histogram, (0, len(histogram) - len(self.gap_histogram)))
+		self.gap_histogram[:len(histogram)] += histogram
+
+		self.add(len(packets)*payload.shape[1]*8, bit_errors, gaps['sent'], gaps['lost'])
+		return self.status()
+
+	def feed(self, data):
+		#raw bytes from the reciever
+		return self.update(self.framer.feed(data))
+
+	def BER_interval(self):
+		return wilson_interval(self.bit_errors, self.bits, self.z)
+
+	def PER_interval(self):
+		return wilson_interval(self.lost, self.packets, self.z)
+
+	def status(self):
+		BER_low, BER_high = self.BER_interval()
+		PER_low, PER_high = self.PER_interval()
+		if BER_low > self.reject_BER or PER_low > self.reject_PER:
+			return 'reject'
+		if BER_high < self.target_BER and PER_high < self.target_PER and self.packets >= self.min_packets:
+			return 'accept'
+		return 'pending'
+
+	def result(self):
+		#the estimate so far, as fields for a result_store row plus the intervals
+		result = {}
+		result['BER'] = self.bit_errors/self.bits if self.bits > 0 else 1.
+		result['PER'] = self.lost/self.packets if self.packets > 0 else 1.
+		result['BER_interval'] = self.BER_interval()
+		result['PER_interval'] = self.PER_interval()
+		result['packets'] = self.packets
+		result['status'] = self.status()
+		return result
+
+
+if __name__ == "__main__":
+	#link_errors against a known number of drops and bit errors, with and without stray packets received as well
+	rng = numpy.random.default_rng(1)
+	transmitted = rng.integers(0, 256, [1000, 64], dtype=numpy.uint8)
+	keep = numpy.ones(len(transmitted), dtype=bool)
+	keep[rng.choice(len(transmitted), 10, replace=False)] = False
+	received = transmitted[keep].copy()
+	flips = rng.random(received.shape + (8,)) < 1e-3
+	received = received ^ numpy.packbits(flips, axis=2)[:, :, 0]
+	stray = rng.integers(0, 256, [20, 64], dtype=numpy.uint8)
+	for name, rx in [('clean', received), ('strays at the end', numpy.concatenate([received, stray])),
+	                 ('duplicates at the end', numpy.concatenate([received, received[-5:]])),
+	                 ('strays in the middle', numpy.concatenate([received[:500], stray, received[500:]]))]:
+		result = link_errors(transmitted, rx)
+		print("%-22s PER %.4f, BER %.2e (%i bits flipped)"%(name, result['PER'], result['BER'], int(flips.sum())))
+		assert result['dropped'] == 10
+		assert result['bit_errors'] == int(flips.sum())
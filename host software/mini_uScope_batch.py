@@ -0,0 +1,136 @@
+import os
+import time
+import argparse
+import concurrent.futures
+import numpy
+import mini_uScope_recording
+import mini_uScope_analysis
+import mini_uScope_results
+import mini_uScope_sweep
+
+#============================================================
+#offline analysis of recorded sweeps (mini_uScope_recording), spread over a process pool.
+#every configuration noted in a recording is one sweep point.  Points are cut into shards of about shard_size bytes
+#on packet edges, and each worker memory maps the recording itself - only a path and two offsets go to the worker,
+#and four counts come back, so nothing big is ever pickled and the work scales with the number of cores.  The counts
+#of each point's shards are summed into BER/PER (bit errors against the FPGA test pattern, lost packets from the
+#header timers, as in mini_uScope_analysis.link_estimator) and appended to a result store.
+#	python mini_uScope_batch.py results_dir recordings/*.raw --workers 32
+
+def decode_config(configuration):
+	#sweep parameters of a configuration noted by recording_writer.note_config: given directly as extras if they were,
+	#otherwise read back from the reciever's register shadow
+	params = {}
+	rx = configuration.get('rx', {})
+	if '15' in rx:
+		params['LNA'] = rx['15']//32
+		params['filt_freq'] = rx['15'] % 32
+	pulses = [rx.get(str(0x10+j), 0) for j in range(12)]
+	if any(pulses):
+		params['pulse_config'] = [j for j in range(12) if pulses[j] != 0]
+		params['pulse_freq'] = [v for v in pulses if v != 0][0] % 32
+	for name in ['LNA', 'filt_freq', 'pulse_freq', 'pulse_config']:
+		if name in configuration:
+			params[name] = configuration[name]
+	return params
+
+def recording_points(reader):
+	#(start, stop, configuration) byte ranges, one per noted configuration; the whole recording if there are none
+	configurations = reader.config.get('configurations', [])
+	if len(configurations) == 0:
+		return [(0, len(reader), {})]
+	points = []
+	for i, configuration in enumerate(configurations):
+		start = configuration['offset']
+		stop = configurations[i+1]['offset'] if i+1 < len(configurations) else len(reader)
+		if stop > start:
+			points.append((start, stop, configuration))
+	return points
+
+def shard_ranges(reader, start, stop, shard_size):
+	edges = [start]
+	for edge in range(start + shard_size, stop, shard_size):
+		edges.append(min(reader.packet_offset(edge), stop))
+	edges.append(stop)
+	return [(a, b) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+def analyse_shard(path, start, stop):
+	#runs in a worker process
+	reader = mini_uScope_recording.recording_reader(path)
+	estimator = mini_uScope_analysis.link_estimator(periodX=reader.periodX, periodY=reader.periodY, clocks_per_packet=reader.clocks_per_packet)
+	for packets in reader.packets(start, stop):
+		estimator.update(packets)
+	return {'bits': estimator.bits, 'bit_errors': estimator.bit_errors, 'packets': estimator.packets, 'lost': estimator.lost}
+
+def point_times(reader, start, stop):
+	index = reader.index
+	if len(index) == 0:
+		return numpy.nan, numpy.nan
+	first = max(numpy.searchsorted(index['offset'], start, side='right') - 1, 0)
+	last = max(numpy.searchsorted(index['offset'], stop, side='left') - 1, 0)
+	return float(index['time'][first]), float(index['time'][last])
+
+def run(paths, store, workers=None, shard_size=16*2**20, log=print):
+	#analyses every point of every recording not already in store; returns the number of rows added
+	jobs = [] #(path, point number, start, stop) of each shard
+	points = {} #(path, point number) -> result row, without the counts
+	for path in paths:
+		reader = mini_uScope_recording.recording_reader(path)
+		for i, (start, stop, configuration) in enumerate(recording_points(reader)):
+			row = decode_config(configuration)
+			row['time_start'], row['time_end'] = point_times(reader, start, stop)
+			#the same recorded point always gets the same hash, so running a batch again only adds what is new
+			row['config_hash'] = mini_uScope_sweep.config_hash(row.get('LNA', -1), row.get('filt_freq', -1), row.get('pulse_freq', -1), row.get('pulse_config', []),
+			                                                   {'recording': os.path.basename(path), 'start': start, 'stop': stop})
+			points[(path, i)] = row
+			for a, b in shard_ranges(reader, start, stop, shard_size):
+				jobs.append((path, i, a, b))
+
+	done = set(int(h) for h in store.column('config_hash'))
+	jobs = [job for job in jobs if points[job[:2]]['config_hash'] not in done]
+	points = {key: row for key, row in points.items() if row['config_hash'] not in done}
+	log("%i points, %i shards to analyse"%(len(points), len(jobs)))
+
+	counts = {key: {'bits': 0, 'bit_errors': 0, 'packets': 0, 'lost': 0} for key in points}
+	remaining = {key: 0 for key in points}
+	for job in jobs:
+		remaining[job[:2]] = remaining[job[:2]] + 1
+
+	added = 0
+	start_time = time.time()
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+		futures = {pool.submit(analyse_shard, path, a, b): (path, i) for path, i, a, b in jobs}
+		for future in concurrent.futures.as_completed(futures):
+			key = futures[future]
+			for name, value in future.result().items():
+				counts[key][name] = counts[key][name] + value
+			remaining[key] = remaining[key] - 1
+			if remaining[key] == 0:
+				#all shards of this point are in: merge and store it straight away
+				row = points[key]
+				total = counts[key]
+				row['BER'] = total['bit_errors']/total['bits'] if total['bits'] > 0 else 1.
+				row['PER'] = total['lost']/total['packets'] if total['packets'] > 0 else 1.
+				store.append(row)
+				added = added + 1
+	log("%i points added in %.1f s"%(added, time.time() - start_time))
+	return added
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="analyse recorded sweeps on a process pool")
+	parser.add_argument('store', help="result store directory to add the results to")
+	parser.add_argument('recordings', nargs='+', help="recordings, by name or by any of their files")
+	parser.add_argument('--workers', type=int, default=None, help="number of processes (default: one per core)")
+	parser.add_argument('--shard-mb', type=float, default=16., help="shard size in MB")
+	args = parser.parse_args()
+
+	paths = []
+	for path in args.recordings:
+		name, extension = os.path.splitext(path)
+		path = name if extension in ['.raw', '.idx', '.json'] else path
+		if path not in paths:
+			paths.append(path)
+	store = mini_uScope_results.result_store(args.store)
+	run(paths, store, args.workers, int(args.shard_mb*2**20))
+	store.close()
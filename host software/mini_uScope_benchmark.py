@@ -0,0 +1,188 @@
+import sys
+import time
+import json
+import argparse
+import numpy
+import mini_uScope_interfaces
+import mini_uScope_analysis
+import mini_uScope_reconstruction
+import mini_uScope_simulator
+
+#============================================================
+#throughput benchmark for the host side of the acquisition-to-image pipeline.
+#each stage is timed on its own, over the same capture - either a recorded one (raw bytes as read from rx_FIFO) or a
+#synthetic stream from mini_uScope_simulator - and the results come out as JSON, so runs can be compared over time:
+#	python mini_uScope_benchmark.py --packets 500000 --output bench.json
+#	python mini_uScope_benchmark.py --input capture.bin
+#stages:
+#	fifo_read:     rx_FIFO.read_data_time against a simulated device, i.e. the host cost of polling and joining chunks
+#	framing:       mini_uScope_interfaces.packet_framer, fed in chunks the way a stream arrives
+#	timer_decode:  header timers -> frame phase (image_reconstructor.header_phases)
+#	ber:           mini_uScope_analysis.link_errors against the transmitted packets
+#	binning:       image_reconstructor.feed, packets -> pixels
+
+stage_names = ['fifo_read', 'framing', 'timer_decode', 'ber', 'binning']
+
+def percentiles(values):
+	values = numpy.asarray(values)
+	if len(values) == 0:
+		return {}
+	return {'p50': float(numpy.percentile(values, 50)), 'p99': float(numpy.percentile(values, 99)), 'max': float(values.max())}
+
+def time_stage(fn, nbytes, npackets, repeat):
+	#runs fn() repeat times; fn returns a list of per-chunk latencies in seconds (possibly empty)
+	seconds = []
+	chunk_latency = []
+	for i in range(repeat):
+		start = time.perf_counter()
+		latency = fn()
+		seconds.append(time.perf_counter() - start)
+		chunk_latency.extend(latency)
+	best = min(seconds)
+	result = {}
+	result['bytes'] = int(nbytes)
+	result['packets'] = int(npackets)
+	result['seconds'] = seconds
+	result['MB_per_s'] = nbytes/best/1e6 if best > 0 else None
+	result['us_per_packet'] = best/npackets*1e6 if npackets > 0 else None
+	if len(chunk_latency) > 0:
+		result['chunk_latency_ms'] = {k: v*1e3 for k, v in percentiles(chunk_latency).items()}
+	return result
+
+def synthetic_capture(npackets, drop_rate=0., bit_error_rate=0., slip_rate=0., seed=0):
+	#(transmitted, received): the clean packet stream as [n, 64] uint8, and the bytes that arrive after the impairments
+	clean = mini_uScope_simulator.sim_link(seed=seed, payload=mini_uScope_simulator.random_payload)
+	transmitted = clean.stream_packets(npackets)
+	link = mini_uScope_simulator.sim_link(drop_rate, bit_error_rate, slip_rate, seed=seed + 1)
+	received = transmitted.copy()
+	keep = link.rng.random(npackets) >= drop_rate
+	received = received[keep]
+	link.corrupt(received)
+	if slip_rate > 0:
+		slipped = numpy.flatnonzero(link.rng.random(len(received)) < slip_rate)
+		mask = numpy.ones(received.shape, dtype=bool)
+		lengths = link.rng.integers(1, mini_uScope_interfaces.packet_size, len(slipped))
+		mask[slipped] = numpy.arange(mini_uScope_interfaces.packet_size)[None, :] < lengths[:, None]
+		return transmitted, received[mask].tobytes()
+	return transmitted, received.tobytes()
+
+def recorded_capture(path):
+	#a raw capture has no record of what was sent, so the reference is what the FPGA test pattern would have been:
+	#the received headers with the 4..63 ramp payload
+	with open(path, 'rb') as f:
+		received = f.read()
+	packets = mini_uScope_interfaces.frame_packets(received)
+	transmitted = packets.copy()
+	transmitted['payload'] = numpy.arange(4, 64, dtype=numpy.uint8)
+	return transmitted.view(numpy.uint8).reshape([len(packets), mini_uScope_interfaces.packet_size]), received
+
+def run(received, transmitted, stages=stage_names, chunk=65536, repeat=3, fifo_seconds=1., fifo_rate=50e6, periodX=996, periodY=1000):
+	results = {}
+	nbytes = len(received)
+	packets = mini_uScope_interfaces.frame_packets(received, periodX, periodY)
+	npackets = len(packets)
+
+	if 'fifo_read' in stages:
+		#simulated device producing data far faster than the real link, so the host side is what limits the rate
+		link = mini_uScope_simulator.sim_link(byte_rate=fifo_rate)
+		fifo = mini_uScope_interfaces.rx_FIFO(dev=link.fifo_device(queue_size=int(fifo_rate)))
+		captured = {}
+		def fifo_read():
+			fifo.read_data()
+			captured['data'] = fifo.read_data_time(fifo_seconds)
+			return []
+		result = time_stage(fifo_read, 0, 0, 1)
+		n = len(captured['data'])
+		result['bytes'] = n
+		result['packets'] = n//mini_uScope_interfaces.packet_size
+		result['MB_per_s'] = n/result['seconds'][0]/1e6
+		result['device_MB_per_s'] = fifo_rate/1e6
+		results['fifo_read'] = result
+
+	if 'framing' in stages:
+		def framing():
+			latency = []
+			framer = mini_uScope_interfaces.packet_framer(periodX, periodY)
+			for i in range(0, nbytes, chunk):
+				start = time.perf_counter()
+				framer.feed(received[i:i+chunk], final=i+chunk >= nbytes)
+				latency.append(time.perf_counter() - start)
+			return latency
+		results['framing'] = time_stage(framing, nbytes, npackets, repeat)
+
+	reconstructor = mini_uScope_reconstruction.image_reconstructor(periodX, periodY)
+	if 'timer_decode' in stages:
+		def timer_decode():
+			reconstructor.header_phases(packets)
+			return []
+		results['timer_decode'] = time_stage(timer_decode, npackets*4, npackets, repeat) #4 header bytes per packet
+
+	if 'ber' in stages:
+		rx_packets = packets.view(numpy.uint8).reshape([npackets, mini_uScope_interfaces.packet_size])
+		ber = {}
+		def link_errors():
+			ber.update(mini_uScope_analysis.link_errors(transmitted, rx_packets))
+			return []
+		result = time_stage(link_errors, npackets*mini_uScope_interfaces.packet_size, npackets, repeat)
+		result['BER'] = ber['BER']
+		result['PER'] = ber['PER']
+		results['ber'] = result
+
+	if 'binning' in stages:
+		packets_per_chunk = max(chunk//mini_uScope_interfaces.packet_size, 1)
+		#a fresh reconstructor for each repeat, built (tables and all) before the timing starts
+		binners = [mini_uScope_reconstruction.image_reconstructor(periodX, periodY) for i in range(repeat)]
+		def binning():
+			latency = []
+			binner = binners.pop()
+			for i in range(0, npackets, packets_per_chunk):
+				start = time.perf_counter()
+				binner.feed(packets[i:i+packets_per_chunk])
+				latency.append(time.perf_counter() - start)
+			return latency
+		results['binning'] = time_stage(binning, npackets*mini_uScope_interfaces.packet_size, npackets, repeat)
+
+	return results
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="benchmark the host side of the acquisition pipeline")
+	parser.add_argument('--input', help="raw capture file to use instead of a synthetic stream")
+	parser.add_argument('--packets', type=int, default=200000, help="length of the synthetic stream")
+	parser.add_argument('--drop-rate', type=float, default=0.01)
+	parser.add_argument('--bit-error-rate', type=float, default=1e-5)
+	parser.add_argument('--slip-rate', type=float, default=1e-4)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--stages', default=','.join(stage_names), help="comma separated subset of: " + ', '.join(stage_names))
+	parser.add_argument('--chunk', type=int, default=65536, help="bytes per chunk for the streaming stages")
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--fifo-seconds', type=float, default=1.)
+	parser.add_argument('--fifo-rate', type=float, default=50e6, help="byte rate of the simulated device for fifo_read")
+	parser.add_argument('--output', help="write the JSON here instead of stdout")
+	args = parser.parse_args()
+
+	if args.input is not None:
+		transmitted, received = recorded_capture(args.input)
+		source = {'input': args.input}
+	else:
+		transmitted, received = synthetic_capture(args.packets, args.drop_rate, args.bit_error_rate, args.slip_rate, args.seed)
+		source = {'packets': args.packets, 'drop_rate': args.drop_rate, 'bit_error_rate': args.bit_error_rate, 'slip_rate': args.slip_rate, 'seed': args.seed}
+
+	stages = [name for name in args.stages.split(',') if name != '']
+	for name in stages:
+		if name not in stage_names:
+			parser.error("unknown stage %s"%name)
+	report = {}
+	report['time'] = time.time()
+	report['python'] = sys.version.split()[0]
+	report['numpy'] = numpy.__version__
+	report['source'] = source
+	report['chunk'] = args.chunk
+	report['stages'] = run(received, transmitted, stages, args.chunk, args.repeat, args.fifo_seconds, args.fifo_rate)
+
+	text = json.dumps(report, indent=1)
+	if args.output is not None:
+		with open(args.output, 'w') as f:
+			f.write(text)
+	else:
+		print(text)
@@ -0,0 +1,291 @@
+import os
+import sys
+import json
+import time
+import socket
+import threading
+
+#============================================================
+#acquisition daemon: one long running process owns the transmitter/reciever handles (a link_session with its fifo),
+#so the USB devices are enumerated, opened and configured once, and the register shadows stay warm between jobs -
+#a config_UWB that changes one register costs one register write.  Short lived clients talk to it over a unix socket
+#with one JSON object per line:  {"command": "capture", "seconds": 0.2}  ->  {"ok": true, "result": {...}}
+#this part of the module only imports the standard library, so a client starts in milliseconds; everything heavy
+#(numpy, pyftdi, ftd2xx, the pipeline modules) is imported by the server when it starts.
+#	python mini_uScope_daemon.py serve [--sim]
+#	python mini_uScope_daemon.py config_UWB filt_val=25 pulse_config=[1,2,3]
+#	python mini_uScope_daemon.py capture seconds=0.5
+
+default_socket = os.environ.get('MINI_USCOPE_SOCKET', '/tmp/mini_uScope.sock')
+
+
+class daemon_client():
+	def __init__(self, socket_path=default_socket, timeout=None):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.settimeout(timeout)
+		self.sock.connect(socket_path)
+		self.stream = self.sock.makefile('rwb')
+
+	def call(self, command, **args):
+		request = dict(args)
+		request['command'] = command
+		self.stream.write(json.dumps(request).encode() + b'\n')
+		self.stream.flush()
+		line = self.stream.readline()
+		if len(line) == 0:
+			raise RuntimeError("daemon closed the connection")
+		response = json.loads(line)
+		if not response['ok']:
+			raise RuntimeError(response['error'])
+		return response['result']
+
+	def ping(self):
+		return self.call('ping')
+
+	def status(self):
+		return self.call('status')
+
+	def config_UWB(self, LNA_val=4, filt_val=24, pulse_freq=25, pulse_config=[1,2,3,4,5]):
+		return self.call('config_UWB', LNA_val=LNA_val, filt_val=filt_val, pulse_freq=pulse_freq, pulse_config=pulse_config)
+
+	def read_reg(self, direction, address, cached=True):
+		return self.call('read_reg', direction=direction, address=address, cached=cached)
+
+	def write_reg(self, direction, address, value):
+		return self.call('write_reg', direction=direction, address=address, value=value)
+
+	def set_mirror_periods(self, periodX, periodY):
+		return self.call('set_mirror_periods', periodX=periodX, periodY=periodY)
+
+	def capture(self, seconds, path=None, estimate=True):
+		#path: record to this recording (mini_uScope_recording) on the daemon's side instead of just measuring
+		return self.call('capture', seconds=seconds, path=path, estimate=estimate)
+
+	def sweep(self, points, store, capture_time=0.2, settings={}):
+		#points: [LNA_val, filt_val, pulse_freq, pulse mask] each; results go into the result store directory store
+		return self.call('sweep', points=points, store=store, capture_time=capture_time, settings=settings)
+
+	def shutdown(self):
+		return self.call('shutdown')
+
+	def close(self):
+		self.stream.close()
+		self.sock.close()
+
+
+def plain(value):
+	#numpy scalars and arrays -> json-able python values
+	if hasattr(value, 'tolist'):
+		return value.tolist()
+	if isinstance(value, dict):
+		return {str(k): plain(v) for k, v in value.items()}
+	if isinstance(value, (list, tuple)):
+		return [plain(v) for v in value]
+	return value
+
+
+class acquisition_daemon():
+	#commands run one at a time on the hardware (hardware_lock); ping and status answer straight away even while a
+	#sweep is running
+	def __init__(self, session, socket_path=default_socket):
+		import mini_uScope_interfaces
+		self.session = session
+		self.socket_path = socket_path
+		self.hardware_lock = threading.Lock()
+		self.start_time = time.time()
+		self.jobs = 0
+		self.commands = {'ping': self.ping, 'status': self.status, 'config_UWB': self.config_UWB, 'read_reg': self.read_reg, 'write_reg': self.write_reg,
+		                 'set_mirror_periods': self.set_mirror_periods, 'capture': self.capture, 'sweep': self.sweep, 'shutdown': self.shutdown}
+		self.unlocked = {'ping', 'status', 'shutdown'}
+		self.registers = {} #register shadows and mirror periods as the last hardware command left them, for status
+		self.save_registers()
+		mini_uScope_interfaces.metrics.enabled = True
+
+	def radio(self, direction):
+		if direction == 'tx':
+			return self.session.tx
+		if direction == 'rx':
+			return self.session.rx
+		raise ValueError("direction must be 'tx' or 'rx', not %s"%direction)
+
+	def ping(self):
+		return {'uptime': time.time() - self.start_time, 'jobs': self.jobs, 'pid': os.getpid()}
+
+	def save_registers(self):
+		#called with the hardware lock held (or before serving), so the shadows aren't changing underneath the copy
+		self.registers = {'tx': {str(a): v for a, v in sorted(self.session.tx.shadow.items())},
+		                  'rx': {str(a): v for a, v in sorted(self.session.rx.shadow.items())},
+		                  'periods': list(self.session.tx.mirror_periods())}
+
+	def status(self):
+		#answers without waiting for a running job: the registers are the copy taken when the last job finished
+		import mini_uScope_interfaces
+		result = self.ping()
+		result['busy'] = self.hardware_lock.locked()
+		result.update(self.registers)
+		result['metrics'] = mini_uScope_interfaces.metrics.snapshot()
+		return result
+
+	def config_UWB(self, LNA_val=4, filt_val=24, pulse_freq=25, pulse_config=[1,2,3,4,5]):
+		writes = [self.session.tx.writes_skipped, self.session.rx.writes_skipped]
+		self.session.config_UWB(LNA_val, filt_val, pulse_freq, pulse_config)
+		return {'writes_skipped': self.session.tx.writes_skipped + self.session.rx.writes_skipped - sum(writes)}
+
+	def read_reg(self, direction, address, cached=True):
+		return self.radio(direction).read_regs([address], cached)[address]
+
+	def write_reg(self, direction, address, value):
+		radio = self.radio(direction)
+		prev_config = radio.set_config_byte(6)
+		radio.write_reg(address, value)
+		radio.set_config_byte(prev_config)
+
+	def set_mirror_periods(self, periodX, periodY):
+		self.session.tx.set_mirror_periods(periodX, periodY)
+
+	def capture(self, seconds, path=None, estimate=True):
+		import mini_uScope_analysis
+		import mini_uScope_recording
+		fifo = self.session.fifo
+		periodX, periodY = self.session.tx.mirror_periods()
+		estimator = mini_uScope_analysis.link_estimator(periodX=periodX, periodY=periodY) if estimate else None
+		recorder = None
+		if path is not None:
+			recorder = mini_uScope_recording.recording_writer(path, periodX, periodY)
+			recorder.note_config(self.session.tx, self.session.rx)
+		fifo.read_data() #discard whatever was queued before the capture started
+		start = time.time()
+		nbytes = 0
+		while time.time() - start < seconds:
+			data = fifo.poll()
+			if len(data) == 0:
+				time.sleep(0.001)
+				continue
+			nbytes = nbytes + len(data)
+			if recorder is not None:
+				recorder.write(data)
+			if estimator is not None:
+				estimator.feed(data)
+		result = {'bytes': nbytes, 'seconds': time.time() - start}
+		if recorder is not None:
+			recorder.close()
+			result['path'] = path
+		if estimator is not None:
+			result.update(estimator.result())
+		return result
+
+	def sweep(self, points, store, capture_time=0.2, settings={}):
+		import mini_uScope_analysis
+		import mini_uScope_results
+		import mini_uScope_sweep
+		def measure(LNA_val, filt_val, pulse_freq, pulse_config):
+			self.session.config_UWB(LNA_val, filt_val, pulse_freq, pulse_config)
+			self.session.tx.set_config_byte(1)
+			self.session.fifo.read_data() #discard data queued under the previous point (capture also lets in-flight packets settle)
+			result = {'LNA': LNA_val, 'filt_freq': filt_val, 'pulse_freq': pulse_freq, 'pulse_config': pulse_config, 'time_start': time.time()}
+			periodX, periodY = self.session.tx.mirror_periods()
+			estimator = mini_uScope_analysis.link_estimator(periodX=periodX, periodY=periodY)
+			data, aborted = mini_uScope_sweep.capture(self.session.fifo, capture_time, estimator=estimator)
+			estimate = estimator.result()
+			result['BER'] = 1. if aborted else estimate['BER']
+			result['PER'] = 1. if aborted else estimate['PER']
+			result['RSSI'] = self.session.rx.read_regs([0x22])[0x22]
+			result['time_end'] = time.time()
+			return result
+		results = mini_uScope_results.result_store(store)
+		settings = dict(settings)
+		settings['capture_time'] = capture_time
+		runner = mini_uScope_sweep.sweep_runner(results, measure, settings)
+		rows = [result for point, result in runner.run([tuple(point) for point in points])]
+		results.close()
+		return {'measured': runner.measured, 'resumed': runner.resumed, 'results': rows}
+
+	def shutdown(self):
+		threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+	def handle(self, request):
+		try:
+			command = request.pop('command')
+			if command not in self.commands:
+				raise ValueError("unknown command %s"%command)
+			if command in self.unlocked:
+				result = self.commands[command](**request)
+			else:
+				with self.hardware_lock:
+					try:
+						result = self.commands[command](**request)
+					finally:
+						self.jobs = self.jobs + 1
+						self.save_registers()
+			return {'ok': True, 'result': plain(result)}
+		except Exception as e:
+			return {'ok': False, 'error': "%s: %s"%(type(e).__name__, e)}
+
+	def serve(self):
+		import socketserver
+		daemon = self
+		class handler(socketserver.StreamRequestHandler):
+			def handle(self):
+				for line in self.rfile:
+					if len(line.strip()) == 0:
+						continue
+					try:
+						request = json.loads(line)
+					except ValueError as e:
+						response = {'ok': False, 'error': "bad request: %s"%e}
+					else:
+						response = daemon.handle(request)
+					self.wfile.write(json.dumps(response).encode() + b'\n')
+					self.wfile.flush()
+
+		#a socket file left behind by a daemon that died is removed; one that still answers means we're already running
+		if os.path.exists(self.socket_path):
+			try:
+				daemon_client(self.socket_path, timeout=1).ping()
+				raise RuntimeError("a daemon is already running on %s"%self.socket_path)
+			except (ConnectionRefusedError, FileNotFoundError, socket.timeout):
+				os.remove(self.socket_path)
+		self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, handler)
+		self.server.daemon_threads = True
+		try:
+			self.server.serve_forever()
+		finally:
+			self.server.server_close()
+			if os.path.exists(self.socket_path):
+				os.remove(self.socket_path)
+
+
+def open_session(sim=False):
+	#the hardware (or simulator), opened and configured once for the life of the daemon
+	import mini_uScope_interfaces
+	if sim:
+		import mini_uScope_simulator
+		session = mini_uScope_simulator.sim_session()
+	else:
+		tx = mini_uScope_interfaces.rxtx_SPI('tx')
+		rx = mini_uScope_interfaces.rxtx_SPI('rx')
+		fifo = mini_uScope_interfaces.rx_FIFO()
+		session = mini_uScope_interfaces.link_session(tx, rx, fifo)
+	session.config_UWB()
+	return session
+
+def parse_value(text):
+	try:
+		return json.loads(text)
+	except ValueError:
+		return text #plain strings don't need quotes
+
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		print("usage: mini_uScope_daemon.py serve [--sim] | <command> [name=value ...]")
+		sys.exit(1)
+	if sys.argv[1] == 'serve':
+		daemon = acquisition_daemon(open_session('--sim' in sys.argv))
+		print("serving on %s"%daemon.socket_path)
+		daemon.serve()
+	else:
+		args = dict(arg.split('=', 1) for arg in sys.argv[2:])
+		client = daemon_client()
+		print(json.dumps(client.call(sys.argv[1], **{name: parse_value(value) for name, value in args.items()}), indent=1))
+		client.close()
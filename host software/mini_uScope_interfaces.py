@@ -1,19 +1,232 @@
 import math
-from pyftdi.spi import SpiController
-from pyftdi.ftdi import Ftdi
-import ftd2xx
 import time
+import threading
+import concurrent.futures
+import numpy
+
+#hardware libraries are only needed to talk to real devices; without them the module still loads, so the framing and
+#analysis code (and the simulator in mini_uScope_simulator) run on machines with no FTDI drivers installed
+try:
+	from pyftdi.spi import SpiController
+	from pyftdi.ftdi import Ftdi
+except ImportError:
+	SpiController = None
+	Ftdi = None
+try:
+	import ftd2xx
+except ImportError:
+	ftd2xx = None
+
+#============================================================
+#metrics for the hot paths: SPI exchanges, FIFO polls, register cache.  Off by default, and while off every
+#instrumented call costs one attribute check.  Turn on with metrics.enabled = True, then look at metrics.snapshot(),
+#or have it printed every few seconds with metrics.start_log().
+
+class interface_metrics():
+	def __init__(self):
+		self.enabled = False
+		self.lock = threading.Lock()
+		self.log_thread = None
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.counts = {} #name -> number of events
+			self.bytes = {} #name -> total bytes moved by those events
+			self.seconds = {} #name -> total time spent in them
+			self.high_water = {} #name -> largest value seen
+			self.start = time.time()
+
+	def event(self, name, seconds, nbytes=0):
+		with self.lock:
+			self.counts[name] = self.counts.get(name, 0) + 1
+			self.bytes[name] = self.bytes.get(name, 0) + nbytes
+			self.seconds[name] = self.seconds.get(name, 0.) + seconds
+
+	def count(self, name, n=1):
+		with self.lock:
+			self.counts[name] = self.counts.get(name, 0) + n
+
+	def mark(self, name, value):
+		#high-water mark
+		with self.lock:
+			if value > self.high_water.get(name, 0):
+				self.high_water[name] = value
+
+	def snapshot(self):
+		#copy of everything so far, plus per event averages: {name: {'count', 'per_s', 'bytes_per_event', 'us_per_event'}}
+		with self.lock:
+			snapshot = {'elapsed': time.time() - self.start, 'counts': dict(self.counts), 'bytes': dict(self.bytes), 'seconds': dict(self.seconds), 'high_water': dict(self.high_water)}
+		averages = {}
+		for name, n in snapshot['counts'].items():
+			average = {'count': n, 'per_s': n/snapshot['elapsed'] if snapshot['elapsed'] > 0 else 0.}
+			if name in snapshot['seconds'] and n > 0:
+				average['bytes_per_event'] = snapshot['bytes'][name]/n
+				average['us_per_event'] = snapshot['seconds'][name]/n*1e6
+			averages[name] = average
+		snapshot['averages'] = averages
+		return snapshot
+
+	def summary(self):
+		#one line version of snapshot(), for logging
+		snapshot = self.snapshot()
+		parts = []
+		for name, average in sorted(snapshot['averages'].items()):
+			if 'us_per_event' in average:
+				parts.append("%s %i (%.0f/s, %.1f B, %.0f us)"%(name, average['count'], average['per_s'], average['bytes_per_event'], average['us_per_event']))
+			else:
+				parts.append("%s %i"%(name, average['count']))
+		for name, value in sorted(snapshot['high_water'].items()):
+			parts.append("max %s %i"%(name, value))
+		return ", ".join(parts)
+
+	def start_log(self, interval=10., log=print):
+		#calls log(summary) every interval seconds from a background thread, until stop_log()
+		self.enabled = True
+		self.logging = True
+		def log_loop():
+			while self.logging:
+				time.sleep(interval)
+				if self.logging:
+					log(self.summary())
+		self.log_thread = threading.Thread(target=log_loop, daemon=True)
+		self.log_thread.start()
+
+	def stop_log(self):
+		self.logging = False
+
+metrics = interface_metrics()
+
 
 #============================================================
 #general info here, haha
 
+#UWB registers that are not plain settings: status, FIFO and command registers change underneath us or have side effects
+#when written, so they are never skipped and never served from the shadow copy in rxtx_SPI
+volatile_regs = {0, 1, 2, 3, 0x1F, 0x22, 0x23, 0x3F}
+
+def plan_reg_writes(regs, known={}, max_gap=2):
+	#turns {address: value} into as few UWB write transactions as possible.
+	#registers at contiguous addresses become one burst write (command byte address+64+128, address auto-increments);
+	#gaps of up to max_gap registers are bridged when the value of every register in the gap is known (e.g. from the
+	#shadow copy), by rewriting it with that same value.  Volatile registers are never part of a burst, and are written
+	#last, in the order given, so command writes like 0x1F happen after the settings they act on.
+	#returns a list of transaction payloads (lists of ints, without the config byte)
+	addresses = sorted(a for a in regs if a not in volatile_regs)
+	runs = []
+	for address in addresses:
+		if len(runs) > 0:
+			start, values = runs[-1]
+			end = start + len(values)
+			gap = range(end, address)
+			if len(gap) <= max_gap and all(a in known and a not in volatile_regs for a in gap):
+				values.extend([known[a] for a in gap] + [regs[address]])
+				continue
+		runs.append((address, [regs[address]]))
+
+	transactions = []
+	for start, values in runs:
+		if len(values) == 1:
+			transactions.append([start+64] + values)
+		else:
+			transactions.append([start+64+128] + values)
+	for address in regs:
+		if address in volatile_regs:
+			transactions.append([address+64, regs[address]])
+	return transactions
+
+def config_regs(direction, LNA_val=4,filt_val=24,pulse_freq=25,pulse_config=[1,2,3,4,5]):
+	#register values making up a UWB configuration of the 'tx' or 'rx' radio, in the order they are written: {address: value}
+	regs = {}
+
+	#power cycling settings:
+	regs[4] = 0 #set device to only return to IDLE state between packets, rather than returning to a lower & slower power mode
+	regs[5] = 128 #set device to go into ACTIVE mode automatically when timer triggers
+	regs[6] = 0 #set timer high period to 0
+	regs[7] = 8 #set timer low period to 8
+	regs[14] = 192 #disable automatic RX buffer flushing
+
+	regs[0x2F] = 32 #set preamble to 16*2=32 clock cycles
+	if direction == 'tx':
+		regs[0x2C] = 128+0 #set modem to automatically transmit after waking up, and do 1.33 rate FEC
+		regs[0x3C] = 64 #set 64 byte packet transmission
+	else:
+		regs[0x2C] = 0 #set modem to do 1.33 rate FEC; the reciever never transmits (as mini_uScope_reciever.rx_m)
+	regs[0x3D] = 64 #set 64 byte packet reception
+
+	# regs[0x3E] = 0 #set source of transmission size to reg 0x3C.  Despite what datasheet says, does not seem to do anything
+
+	#register 1F: power status and commands: a whole bunch of details in here
+	if direction == 'tx':
+		regs[0x1F] = 16 #set device to transmitter mode, and send a start transmission command
+	else:
+		pass #if rx, the default value of this register is good
+
+	regs[0x0F] = LNA_val*32+filt_val #reciever frequency tuning register
+
+	#the twelve pulse-parameter registers
+	pulses = [0]*12
+	for indx in pulse_config:
+		pulses[indx] = pulse_freq+128+64+32
+	for j in range(12):
+		regs[0x10+j] = pulses[j]
+	return regs
+
+#the FPGA's SPI bridge to the radio buffers spi_frame_size bytes per transaction, and the radio's TX FIFO holds
+#tx_fifo_size bytes
+spi_frame_size = 8
+tx_fifo_size = 128
+
+def fifo_write_frames(data):
+	#data -> burst writes of the FIFO register (0x3F+64+128), spi_frame_size bytes each
+	if isinstance(data, (bytes, bytearray, memoryview)):
+		data = numpy.frombuffer(data, dtype=numpy.uint8)
+	else:
+		data = numpy.asarray(data, dtype=numpy.uint8)
+	return [[0x3F+64+128] + data[i:i+spi_frame_size].tolist() for i in range(0, len(data), spi_frame_size)]
+
+def list_devices():
+	#every FTDI device/interface that can be seen, as dicts of driver ('d2xx' or 'libusb'), serial, description, type.
+	#the FIFO channels show up under D2XX, the SPI interfaces (on libusbK) under pyftdi; either library may be missing
+	devices = []
+	if ftd2xx is not None:
+		for i in range(len(ftd2xx.listDevices(0) or [])):
+			detail = ftd2xx.getDeviceInfoDetail(i)
+			devices.append({'driver': 'd2xx', 'index': i, 'serial': detail['serial'].decode(errors='replace'), 'description': detail['description'].decode(errors='replace'), 'type': detail['type'], 'id': detail['id']})
+	if Ftdi is not None:
+		for descriptor, interfaces in Ftdi.list_devices():
+			devices.append({'driver': 'libusb', 'serial': descriptor.sn, 'description': descriptor.description, 'type': '%04x:%04x'%(descriptor.vid, descriptor.pid), 'interfaces': interfaces})
+	return devices
+
 class rxtx_SPI():
-	def __init__(self, direction, verbose=False): #direction can be either 'rx' or 'tx'
+	def __init__(self, direction, verbose=False, slave=None, serial=None): #direction can be either 'rx' or 'tx'
+		#slave: an already opened SPI port to use instead of opening the FTDI device (e.g. a mini_uScope_simulator port)
+		#serial: USB serial number of the FTDI device, to pick one rig's out of several (see list_devices)
+		self.verbose = verbose #flag to print some extra diagnostic stuff
+		self.direction = direction
+
+		if slave is not None:
+			self.slave = slave
+		else:
+			self.open_FTDI(direction, serial)
+		#mirror timer periods, as the host scripts assume them until set_mirror_periods is called
+		self.periodX = 996
+		self.periodY = 1000
+
+		#shadow copy of the UWB register file: address -> last value written to or read from the radio.
+		#writes of an unchanged value are skipped, and reads are answered from here when possible
+		self.shadow = {}
+		self.writes_skipped = 0
+		self.cache_hits = 0
+
+		#set an initial configuration for the reciever or transmitter
+		self.config_byte = 1
+		self.config_UWB()
+
+	def open_FTDI(self, direction, serial=None):
 		#chip select pin indices are hardcoded to pins in the following order: 0->D3, 1->D4, 2->D5, 3->D6, 4->D7 (5 Chip selects max)
 		self.spi = SpiController(cs_count=2) #chip selects are on the second one, so we need at least 2.
 		
-		self.verbose = verbose #flag to print some extra diagnostic stuff
-
 		## Select and configure which FTDI interface to use
 		#limit which device we will conect to.  This has two purposes:
 		#1) determines whether we are connecting to the RX or TX FPGA unit of the mini microscope system
@@ -21,89 +234,183 @@ class rxtx_SPI():
 		if direction == 'tx':
 			Ftdi.PRODUCT_IDS = {1027:{'232h':24596,'ft232h':24596}} #0x0403:0x6014 -> default Vendor ID : Product ID for ft232h
 			print(Ftdi.list_devices())
-			self.spi.configure('ftdi://:232h/1')
+			self.spi.configure('ftdi://:232h:%s/1'%serial if serial else 'ftdi://:232h/1')
 		elif direction == 'rx':
 			Ftdi.PRODUCT_IDS = {1027:{'2232h':24592,'ft2232h':24592}} #0x0403:0x6010 -> default Vendor ID : Product ID for ft2232h
 			print(Ftdi.list_devices())
-			self.spi.configure('ftdi://:2232h/1')
+			self.spi.configure('ftdi://:2232h:%s/1'%serial if serial else 'ftdi://:2232h/1')
 		else:
 			print("The direction parameter must be either \'tx\' or \'rx\'.")
-		self.direction = direction
 
 		# Get 'port' to a specific device, and specify parameters (cs pin, bus frequency, and SPI mode)
 		self.slave = self.spi.get_port(cs=1, freq=1E6, mode=1)
 
-		#set an initial configuration for the reciever or transmitter
-		self.config_byte = 1
-		self.config_UWB()
+	#all SPI traffic goes through exchange() and write(), so it can be counted
+	def exchange(self, data, readlen=0):
+		if not metrics.enabled:
+			return self.slave.exchange(data, readlen=readlen, duplex=True)
+		start = time.perf_counter()
+		ret = self.slave.exchange(data, readlen=readlen, duplex=True)
+		metrics.event('spi_exchange', time.perf_counter() - start, len(data))
+		return ret
+
+	def write(self, data):
+		if not metrics.enabled:
+			return self.slave.write(data)
+		start = time.perf_counter()
+		self.slave.write(data)
+		metrics.event('spi_write', time.perf_counter() - start, len(data))
 
 	def UWB_transaction(self, payload):
 		data = bytearray([self.config_byte]+payload)
-		data = self.slave.exchange(data, readlen=len(payload)+1, duplex=True)
+		data = self.exchange(data, readlen=len(payload)+1)
 		data = [int(x) for x in data]
 		return data[1:] #exlude first returned byte, which has nothing to do with the UWB transaction
 
+	def UWB_write(self, payload):
+		#write-only transaction: nothing is read back, so it doesn't wait for a USB round trip
+		self.write(bytearray([self.config_byte]+payload))
+
 	def set_config_byte(self, conf):
-		ret = self.slave.exchange(bytearray([conf]), readlen=1, duplex=True)
+		ret = self.exchange(bytearray([conf]), readlen=1)
 		self.config_byte = conf
 		return int(ret[0]) #should return previous config byte value
 
-	def write_reg(self, address, data):
+	def write_reg(self, address, data, force=False):
+		if not force and address not in volatile_regs and self.shadow.get(address) == data:
+			self.writes_skipped = self.writes_skipped + 1
+			if metrics.enabled:
+				metrics.count('reg_writes_skipped')
+			return
 		cmd = [address+64, data]
 		self.UWB_transaction(cmd)
+		if address not in volatile_regs:
+			self.shadow[address] = data
 		#verify data:
 		if self.verbose:
-			data_rx = self.read_reg(address)
+			data_rx = self.read_reg(address, cached=False)
 			print("REG: %i: %i/%i"%(address, data, data_rx))
 			if data_rx != data:
 				print("register write failed")
 
-	def read_reg(self, address):
+	def write_regs(self, regs, force=False):
+		#writes {address: value} with coalesced burst transactions (see plan_reg_writes); unchanged registers are skipped unless force
+		if not force:
+			dirty = self.dirty_regs(regs)
+			self.writes_skipped = self.writes_skipped + len(regs) - len(dirty)
+			if metrics.enabled:
+				metrics.count('reg_writes_skipped', len(regs) - len(dirty))
+			regs = dirty
+		for payload in plan_reg_writes(regs, self.shadow):
+			self.UWB_write(payload)
+		for address, value in regs.items():
+			if address not in volatile_regs:
+				self.shadow[address] = value
+		#verify data:
+		if self.verbose:
+			for address, value in regs.items():
+				data_rx = self.read_reg(address, cached=False)
+				print("REG: %i: %i/%i"%(address, value, data_rx))
+				if data_rx != value:
+					print("register write failed")
+
+	def read_reg(self, address, cached=True):
+		if cached and address in self.shadow:
+			self.cache_hits = self.cache_hits + 1
+			if metrics.enabled:
+				metrics.count('reg_cache_hits')
+			return self.shadow[address]
 		data = [address, 0]
 		data = self.UWB_transaction(data)
-
+		if address not in volatile_regs:
+			self.shadow[address] = data[1]
 		return data[1]
 
-	def write_data(self, data):
-		#since the SPI in the FPGA has a tiny FIFO, break this into 8 byte chunks
-		i = 0
-		datas = []
-		while i<len(data): 
-			datas.append(data[i,min(i+8, len(data))])
-			i = i + 8
+	def read_regs(self, addresses, cached=True):
+		#reads several registers, switching to UWB access and back if needed; returns {address: value}
+		prev_config = self.config_byte
+		values = {}
+		for address in addresses:
+			if not (cached and address in self.shadow) and self.config_byte != 6:
+				self.set_config_byte(6)
+			values[address] = self.read_reg(address, cached)
+		if self.config_byte != prev_config:
+			self.set_config_byte(prev_config)
+		return values
 
-		for data in datas:
-			data = [0x3F+64+128] + data
-			self.UWB_transaction(data)
+	def invalidate(self, addresses=None):
+		#forget the shadow copy (all of it, or some registers), e.g. after the radio has been reset or power cycled
+		if addresses is None:
+			self.shadow.clear()
+		else:
+			for address in addresses:
+				self.shadow.pop(address, None)
 
+	def sync(self, addresses=None):
+		#re-reads the shadowed registers (or the given ones) from the radio.  Returns {address: (shadow, actual)} for any
+		#that had drifted from what we thought they were
+		if addresses is None:
+			addresses = list(self.shadow.keys())
+		before = dict(self.shadow)
+		values = self.read_regs(addresses, cached=False)
+		return {a: (before[a], v) for a, v in values.items() if a in before and before[a] != v}
 
-	def config_UWB(self, LNA_val=4,filt_val=24,pulse_freq=25,pulse_config=[1,2,3,4,5]):
-		#first, set for UWB access:
-		self.set_config_byte(6)
+	def write_data(self, data, packet_length=64, start_tx=True, timeout=1.):
+		#streams data (bytes, bytearray, list of ints or uint8 numpy array, any length) into the radio's TX FIFO, as
+		#packet_length byte packets (register 0x3C).  Call with UWB access on (config byte 6), as for write_reg.
+		#every FIFO write frame is write-only, so nothing waits for a USB round trip except the TX FIFO usage reads, and
+		#those happen at most once per packet, only when our own count says the next packet might not fit: with a 128 byte
+		#FIFO and 64 byte packets one packet is being loaded while the one before it goes out.  start_tx: send the start
+		#transmission command after each packet, queued behind its data rather than waited for.  A last partial packet
+		#stays in the FIFO until the next call completes it.  Raises TimeoutError if there still isn't room for a packet
+		#after timeout seconds (the radio has stopped sending).
+		#returns the number of TX FIFO usage reads it took
+		if packet_length > tx_fifo_size:
+			raise ValueError("packet_length %i doesn't fit in the %i byte TX FIFO"%(packet_length, tx_fifo_size))
+		frames = fifo_write_frames(data)
+		frames_per_packet = -(-packet_length//spi_frame_size)
+		usage_reads = 0
+		free = 0 #bytes we know are free in the TX FIFO; nothing is known until the first read
+		for i in range(0, len(frames), frames_per_packet):
+			packet = frames[i:i+frames_per_packet]
+			length = sum(len(frame) - 1 for frame in packet)
+			deadline = time.time() + timeout
+			while free < length:
+				free = tx_fifo_size - self.read_reg(2, cached=False)
+				usage_reads = usage_reads + 1
+				if free < length and time.time() > deadline:
+					raise TimeoutError("TX FIFO still has only %i bytes free after %.1f s"%(free, timeout))
+			for frame in packet:
+				self.UWB_write(frame)
+			if start_tx:
+				self.UWB_write([0x1F+64, 16])
+			free = free - length
+		if metrics.enabled:
+			metrics.count('tx_fifo_usage_reads', usage_reads)
+		return usage_reads
 
-		#power cycling settings:
-		self.write_reg(4, 0) #set device to only return to IDLE state between packets, rather than returning to a lower & slower power mode
-		self.write_reg(5, 128) #set device to go into ACTIVE mode automatically when timer triggers
-		self.write_reg(6, 0) #set timer high period to 0
-		self.write_reg(7, 8) #set timer low period to 8
-		self.write_reg(14, 192) #disable automatic RX buffer flushing
+	def config_regs(self, LNA_val=4,filt_val=24,pulse_freq=25,pulse_config=[1,2,3,4,5]):
+		return config_regs(self.direction, LNA_val, filt_val, pulse_freq, pulse_config)
 
-		self.write_reg(0x2F, 32) #set preamble to 16*2=32 clock cycles
-		self.write_reg(0x2C, 128+0) #set modem to automatically transmit after waking up, and do 1.33 rate FEC
+	def dirty_regs(self, regs):
+		#the part of a set of register values that actually has to be written
+		return {a: v for a, v in regs.items() if a in volatile_regs or self.shadow.get(a) != v}
 
-		self.write_reg(0x3C, 64) #set 64 byte packet transmission
-		self.write_reg(0x3D, 64) #set 64 byte packet reception
-
-		# self.write_reg(0x3E, 0) #set source of transmission size to reg 0x3C.  Despite what datasheet says, does not seem to do anything
+	def config_UWB(self, LNA_val=4,filt_val=24,pulse_freq=25,pulse_config=[1,2,3,4,5]):
+		#only registers that differ from the shadow copy are written, so moving between sweep points that share
+		#most of their settings only costs the registers that changed
+		wanted = self.config_regs(LNA_val, filt_val, pulse_freq, pulse_config)
+		regs = self.dirty_regs(wanted)
+		self.writes_skipped = self.writes_skipped + len(wanted) - len(regs)
+		if metrics.enabled:
+			metrics.count('reg_writes_skipped', len(wanted) - len(regs))
+		if len(regs) == 0:
+			return
 
-		#register 1F: power status and commands: a whole bunch of details in here
-		if self.direction == 'tx':
-			self.write_reg(0x1F, 16) #set device to transmitter mode, and send a start transmission command
-		else:
-			pass #if rx, the default value of this register is good
+		#first, set for UWB access:
+		self.set_config_byte(6)
 
-		self.write_reg(0x0F, LNA_val*32+filt_val) #reciever frequency tuning register
-		self.config_pulses(pulse_config, pulse_freq)
+		self.write_regs(regs, force=True)
 
 		#return to normal operation when done
 		self.set_config_byte(1)
@@ -114,28 +421,398 @@ class rxtx_SPI():
 		pulses = [0]*12
 		for indx in list_of_pulses:
 			pulses[indx] = pulse_freq+128+64+32
-		data = [0x10+64+128] + pulses
-		self.UWB_transaction(data)
+		self.write_regs({0x10+j: pulses[j] for j in range(12)}) #contiguous, so this is a single burst write
+
+
+	#FPGA config registers (cfg_regs in transmitter.v) are on the FPGA's own slave SPI: 4-byte transfers of [command, address, data MSB, data LSB]
+	#register 0 and 1 are the periodX/periodY of mirror_driver, which set the scan pattern
+	def write_cfg_reg(self, address, value):
+		self.exchange(bytearray([1, address, value >> 8, value & 255]))
+
+	def read_cfg_reg(self, address):
+		self.exchange(bytearray([2, address, 0, 0])) #response is latched at the end of this transfer...
+		ret = self.exchange(bytearray([0, 0, 0, 0]), readlen=4) #...and clocked out during the next one
+		return int(ret[2])*256 + int(ret[3])
+
+	def set_mirror_periods(self, periodX, periodY):
+		#mirror_driver counts from 0 up to and including the register value, so a period of N clocks is written as N-1
+		self.write_cfg_reg(0, periodX-1)
+		self.write_cfg_reg(1, periodY-1)
+		self.periodX = periodX
+		self.periodY = periodY
+
+	def mirror_periods(self):
+		#periods as used for framing and reconstruction, e.g. lut_cache.pixel_map(*tx.mirror_periods(), width, height)
+		return (self.periodX, self.periodY)
+
+
+class ring_buffer():
+	#fixed size circular byte buffer, filled by one thread (the FIFO reader) and drained by another.
+	#positions are kept as running byte totals, so the amount waiting is just written-consumed and nothing ever has to be moved around.
+	#consumers get zero-copy memoryview slices with peek(), and hand the space back with release() once they are done with it.
+	def __init__(self, size):
+		self.size = size
+		self.buf = numpy.zeros(size, dtype=numpy.uint8)
+		self.written = 0 #total bytes ever written
+		self.consumed = 0 #total bytes ever released by the consumer
+		self.dropped = 0 #bytes thrown away because the consumer fell a whole buffer behind
+		self.cond = threading.Condition()
+
+	def available(self):
+		return self.written - self.consumed
+
+	def free(self):
+		return self.size - self.available()
+
+	def write(self, data):
+		#only one writer, and the consumer can only make more room, so free space can be checked without the lock.
+		#if the buffer is full the new data is dropped rather than overwriting data a consumer may still hold a view of
+		data = numpy.frombuffer(data, dtype=numpy.uint8)
+		n = min(len(data), self.free())
+		self.dropped = self.dropped + len(data) - n
+		start = self.written % self.size
+		first = min(n, self.size - start)
+		self.buf[start:start+first] = data[:first]
+		self.buf[:n-first] = data[first:n] #wrap around to the start of the buffer
+		with self.cond:
+			self.written = self.written + n
+			self.cond.notify_all()
+		return n
+
+	def wait(self, n=1, timeout=None):
+		#block until at least n bytes are waiting; returns False on timeout
+		with self.cond:
+			return self.cond.wait_for(lambda: self.available() >= n, timeout)
+
+	def peek(self, n=None):
+		#view of the oldest waiting bytes, without copying.  The view stops at the end of the buffer, so it may be
+		#shorter than what is actually waiting; call again after release() to get the part that wrapped around.
+		start = self.consumed % self.size
+		k = min(self.available(), self.size - start)
+		if n is not None:
+			k = min(k, n)
+		return memoryview(self.buf[start:start+k])
+
+	def release(self, n):
+		with self.cond:
+			self.consumed = self.consumed + min(n, self.available())
+
+	def read(self, n=None):
+		#copying read of up to n bytes (all waiting bytes if n is None), joined across the wrap-around
+		if n is None:
+			n = self.available()
+		n = min(n, self.available())
+		data = bytearray(n)
+		got = 0
+		while got < n:
+			view = self.peek(n - got)
+			data[got:got+len(view)] = view
+			got = got + len(view)
+			self.release(len(view))
+		return data
+
+
+#============================================================
+#packet framing.  uwb_packet_writer in transmitter.v sends 64 byte packets: timerX and timerY (2 bytes each, MSB first)
+#followed by 60 bytes of ADC data.  The FIFO stream has no other markers, so packet edges are found from the timer
+#stamps themselves: consecutive headers always differ by a whole number of packet periods on both timers.
+
+packet_size = 64
+payload_size = 60
+packet_dtype = numpy.dtype([('timerX', '>u2'), ('timerY', '>u2'), ('payload', numpy.uint8, (payload_size,))])
+
+def packet_steps(timerX, timerY, prevX, prevY, periodX=996, periodY=1000, clocks_per_packet=256, max_gap=16):
+	#number of packet periods (1 to max_gap) between each header and the header before it, or 0 if the pair doesn't
+	#fit any whole number of packets - i.e. one of the two headers is corrupted, or the data is not aligned to packets
+	timerX = numpy.asarray(timerX, dtype=numpy.int64)
+	timerY = numpy.asarray(timerY, dtype=numpy.int64)
+	dX = (timerX - prevX) % periodX
+	dY = (timerY - prevY) % periodY
+	k = numpy.arange(1, max_gap+1)
+	match = (dX[..., None] == (k*clocks_per_packet) % periodX) & (dY[..., None] == (k*clocks_per_packet) % periodY)
+	match = match & ((timerX < periodX) & (timerY < periodY))[..., None]
+	return numpy.where(match.any(axis=-1), match.argmax(axis=-1)+1, 0)
+
+class packet_framer():
+	#splits an unbounded byte stream into packets.  Feed it data in whatever chunks it arrives in; it returns the
+	#complete packets found so far as an array of packet_dtype, and keeps any leftover bytes for the next call.
+	#a dropped packet keeps the stream aligned and is just a bigger step between headers, but a short packet shifts
+	#everything after it - when resync_after headers in a row don't follow on, the framer searches for the new alignment.
+	def __init__(self, periodX=996, periodY=1000, clocks_per_packet=256, max_gap=16, lock_packets=16, resync_after=4):
+		self.periodX = periodX
+		self.periodY = periodY
+		self.clocks_per_packet = clocks_per_packet
+		self.max_gap = max_gap
+		self.lock_packets = lock_packets #number of packets looked at when searching for alignment
+		self.resync_after = resync_after #this many bad headers in a row counts as lost alignment, rather than bit errors
+
+		self.pending = numpy.zeros(0, dtype=numpy.uint8)
+		self.locked = False
+		self.prev = None #(timerX, timerY) arrays of the last few packets returned
+		self.packets = 0 #running totals, for diagnostics
+		self.resyncs = 0
+		self.discarded = 0 #bytes skipped while searching for alignment
+
+	def steps(self, timerX, timerY, prevX, prevY):
+		return packet_steps(timerX, timerY, prevX, prevY, self.periodX, self.periodY, self.clocks_per_packet, self.max_gap)
+
+	def find_offset(self, buf):
+		#scores all 64 possible alignments at once, by how many of the following headers follow on from each other
+		#returns -1 if no alignment is convincing (e.g. the stream starts with garbage)
+		rows = numpy.arange(packet_size)[:, None] + packet_size*numpy.arange(self.lock_packets+1)[None, :]
+		hdr = buf[rows[..., None] + numpy.arange(4)].astype(numpy.int64)
+		timerX = hdr[..., 0]*256 + hdr[..., 1]
+		timerY = hdr[..., 2]*256 + hdr[..., 3]
+		score = numpy.sum(self.steps(timerX[:, 1:], timerY[:, 1:], timerX[:, :-1], timerY[:, :-1]) > 0, axis=1)
+		offset = numpy.argmax(score)
+		if score[offset] < self.lock_packets*3//4:
+			return -1
+		return int(offset)
+
+	def feed(self, data, final=False):
+		#final=True returns everything that is left, instead of holding back the last few packets until we know they
+		#aren't the start of a slip
+		buf = numpy.concatenate([self.pending, numpy.frombuffer(data, dtype=numpy.uint8)])
+		holdback = 0 if final else self.resync_after
+		pos = 0
+		out = []
+		while True:
+			if not self.locked:
+				if len(buf) - pos < packet_size*(self.lock_packets+2):
+					break
+				offset = self.find_offset(buf[pos:])
+				if offset < 0:
+					skip = packet_size*max(1, self.lock_packets//2)
+					self.discarded = self.discarded + skip
+					pos = pos + skip
+					continue
+				self.discarded = self.discarded + offset
+				pos = pos + offset
+				self.locked = True
+				self.prev = None
+
+			npackets = (len(buf) - pos)//packet_size
+			nready = npackets - holdback
+			if nready <= 0:
+				break
+			packets = buf[pos:pos+npackets*packet_size].view(packet_dtype)
+
+			#a header is good if it follows on from any of the resync_after headers before it: a few corrupted headers in
+			#a row then don't make the good one after them look bad as well, so it takes a real slip (or resync_after
+			#corrupted headers in a row) to make resync_after bad headers in a row
+			timerX = packets['timerX'].astype(numpy.int64)
+			timerY = packets['timerY'].astype(numpy.int64)
+			history = 0
+			if self.prev is not None:
+				history = len(self.prev[0])
+				timerX = numpy.concatenate([self.prev[0], timerX])
+				timerY = numpy.concatenate([self.prev[1], timerY])
+			good = numpy.zeros(len(timerX), dtype=bool)
+			for back in range(1, self.resync_after + 1):
+				good[back:] = good[back:] | (self.steps(timerX[back:], timerY[back:], timerX[:-back], timerY[:-back]) > 0)
+			good = good[history:]
+			timerX = timerX[history:]
+			timerY = timerY[history:]
+			if history == 0:
+				good[0] = True
+
+			#first place where resync_after headers in a row are bad: alignment was lost at that packet
+			bad_run = numpy.convolve(~good, numpy.ones(self.resync_after, dtype=int), 'valid') == self.resync_after
+			slips = numpy.flatnonzero(bad_run)
+			if len(slips) > 0 and slips[0] < nready:
+				nready = slips[0]
+				self.locked = False
+				self.resyncs = self.resyncs + 1
+
+			if nready > 0:
+				out.append(buf[pos:pos+nready*packet_size]) #raw bytes: concatenating the structured packets would lose their byte order
+				keep = max(nready - self.resync_after, 0)
+				self.prev = (timerX[keep:nready], timerY[keep:nready])
+			pos = pos + nready*packet_size
+			if self.locked:
+				break
+
+		self.pending = buf[pos:].copy()
+		if len(out) == 0:
+			return numpy.zeros(0, dtype=packet_dtype)
+		out = numpy.concatenate(out).view(packet_dtype)
+		self.packets = self.packets + len(out)
+		return out
+
+	def flush(self):
+		return self.feed(b'', final=True)
+
+def frame_packets(data, periodX=996, periodY=1000, clocks_per_packet=256):
+	#one-shot framing of a complete capture
+	return packet_framer(periodX, periodY, clocks_per_packet).feed(data, final=True)
 
 
 class rx_FIFO():
-	def __init__(self):
-		self.dev = ftd2xx.open(0) #open device index 0 - should be the only one since other two are set to libusbk drivers
+	def __init__(self, dev=None, serial=None):
+		#dev: an already opened D2XX-like device to use instead of device index 0 (e.g. a mini_uScope_simulator device)
+		#serial: D2XX serial number of the FIFO channel (the FT2232H's serial plus its channel letter, e.g. 'FT1ABCDEB'),
+		#needed as soon as more than one reciever is plugged in
+		if dev is None and serial is not None:
+			dev = ftd2xx.openEx(serial.encode(), ftd2xx.defines.OPEN_BY_SERIAL_NUMBER)
+		elif dev is None:
+			dev = ftd2xx.open(0) #open device index 0 - should be the only one since other two are set to libusbk drivers
+		self.dev = dev
 		self.dev.setBitMode(0x00, 0x00) #reset - ASYNC FIFO is set in EEPROM settings
 		self.dev.setUSBParameters(32768, 32768)
+		self.stream = None #ring buffer, only exists while streaming
+		self.recorder = None
+		self.pending = 0 #reply bytes still owed for register writes
+		self.streaming = False
 
-	def read_data(self):
+	def poll(self, limit=None):
+		#one look at the FTDI queue, reading whatever is in it (up to limit bytes).  All FIFO reads go through here
+		if metrics.enabled:
+			return self.poll_counted(limit)
 		nbuffered = self.dev.getQueueStatus() #returns number of elements in the queue
-		rx_buffer = self.dev.read(nbuffered)
-		return rx_buffer
+		if limit is not None:
+			nbuffered = min(nbuffered, limit)
+		if nbuffered == 0:
+			return b''
+		return self.dev.read(nbuffered)
+
+	def poll_counted(self, limit=None):
+		start = time.perf_counter()
+		nbuffered = self.dev.getQueueStatus()
+		metrics.mark('fifo_queue_bytes', nbuffered)
+		if limit is not None:
+			nbuffered = min(nbuffered, limit)
+		data = self.dev.read(nbuffered) if nbuffered > 0 else b''
+		metrics.event('fifo_poll', time.perf_counter() - start, len(data))
+		if len(data) == 0:
+			metrics.count('fifo_empty_polls')
+		return data
+
+	def read_data(self):
+		return self.poll()
+
+	#register access over the FIFO channel: each transfer is [length, UWB bytes...], and the reciever FPGA returns the same
+	#number of bytes into the data stream.  Replies owed to earlier writes are counted in self.pending, so reads know what
+	#to discard and then wait for exactly their own reply instead of sleeping.  Not for use while streaming.
+	def read_reply(self, nbytes, timeout=0.1, poll_interval=0.0002):
+		#reads exactly nbytes as soon as they arrive; returns fewer on timeout
+		reply = bytearray()
+		deadline = time.time() + timeout
+		while len(reply) < nbytes:
+			chunk = self.poll(nbytes - len(reply))
+			if len(chunk) > 0:
+				reply += chunk
+			elif time.time() > deadline:
+				break
+			else:
+				time.sleep(poll_interval)
+		return reply
+
+	def drain(self):
+		self.read_reply(self.pending) #discard replies to earlier writes
+		self.pending = 0
+		self.read_data() #and anything else still queued
+
+	def write_reg(self, address, data):
+		self.dev.write(bytes([2, address+64, data]))
+		self.pending = self.pending + 2
+
+	def read_reg(self, address, timeout=0.1):
+		self.drain()
+		self.dev.write(bytes([2, address, 0]))
+		reply = self.read_reply(2, timeout)
+		if len(reply) < 2:
+			return -1
+		return int(reply[1])
 
-	def read_data_time(self, dt):
+	def burst_read(self, address, n, timeout=0.1):
+		#n registers (or n bytes of the RX FIFO at 0x3F) in a single transaction
+		self.drain()
+		self.dev.write(bytes([n+1, address+128] + [0]*n))
+		reply = self.read_reply(n+1, timeout)
+		return [int(x) for x in reply[1:]]
+
+	def read_status(self, timeout=0.1):
+		self.drain()
+		self.dev.write(bytes([2, 0, 0, 2, 0, 0]))
+		reply = self.read_reply(4, timeout)
+		if len(reply) < 4:
+			return (-1, -1)
+		return (int(reply[0]), int(reply[2]))
+
+	def read_data_time(self, dt, poll_interval=0.001):
 		#reads a batch of data over a specified amount of time
-		data = bytearray([])
+		#chunks are collected in a list and joined once at the end; growing one bytearray makes long captures quadratic
+		chunks = []
 		now = time.time()
 		while time.time() < now+dt:
-			data = data + self.read_data()
-		return data
+			chunk = self.read_data()
+			if len(chunk) == 0:
+				time.sleep(poll_interval) #nothing queued yet; don't spin on getQueueStatus
+			chunks.append(chunk)
+		return bytearray().join(chunks)
+
+	#streaming mode: a dedicated thread drains the FTDI queue into a preallocated ring buffer, so the USB side never waits on the analysis.
+	#while streaming, read_data/read_data_time should not be used, since they would steal data from the reader thread.
+	def start_stream(self, buffer_size=64*2**20, poll_interval=0.001, recorder=None):
+		#default buffer holds ~40 s of data at 1.5 MB/s, so the consumer only has to keep up on average.
+		#recorder: optional mini_uScope_recording.recording_writer, which gets every byte read, before the ring buffer
+		self.stream = ring_buffer(buffer_size)
+		self.recorder = recorder
+		self.streaming = True
+		self.stream_thread = threading.Thread(target=self.stream_loop, args=(poll_interval,), daemon=True)
+		self.stream_thread.start()
+		return self.stream
+
+	def stream_loop(self, poll_interval):
+		while self.streaming:
+			data = self.poll()
+			if len(data) == 0:
+				time.sleep(poll_interval)
+				continue
+			if self.recorder is not None:
+				self.recorder.write(data)
+			n = self.stream.write(data)
+			if metrics.enabled:
+				metrics.mark('ring_backlog_bytes', self.stream.available())
+				if n < len(data):
+					metrics.count('ring_dropped_bytes', len(data) - n)
+
+	def stop_stream(self):
+		self.streaming = False
+		self.stream_thread.join()
+		return self.stream
+
+
+class link_session():
+	#owns both ends of the link.  The transmitter (FT232H) and reciever (FT2232H) are separate USB devices, so
+	#configuration and register read-backs run on both at once, and a sweep point costs max(tx, rx) instead of tx+rx.
+	def __init__(self, tx=None, rx=None, fifo=None, verbose=False):
+		#devices are opened one after the other: rxtx_SPI picks its device through the global Ftdi.PRODUCT_IDS (and serial
+		#number, if rxtx_SPI is given one)
+		self.tx = tx if tx is not None else rxtx_SPI('tx', verbose)
+		self.rx = rx if rx is not None else rxtx_SPI('rx', verbose)
+		self.fifo = fifo #rx_FIFO for the data stream, optional
+		self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+	def both(self, tx_fn, rx_fn):
+		#runs tx_fn() and rx_fn() concurrently, returns (tx result, rx result); exceptions are re-raised here
+		tx_result = self.pool.submit(tx_fn)
+		rx_result = self.pool.submit(rx_fn)
+		return tx_result.result(), rx_result.result()
+
+	def config_UWB(self, LNA_val=4,filt_val=24,pulse_freq=25,pulse_config=[1,2,3,4,5]):
+		return self.both(lambda: self.tx.config_UWB(LNA_val, filt_val, pulse_freq, pulse_config),
+		                 lambda: self.rx.config_UWB(LNA_val, filt_val, pulse_freq, pulse_config))
+
+	def read_regs(self, tx_addresses=[], rx_addresses=[], cached=True):
+		return self.both(lambda: self.tx.read_regs(tx_addresses, cached),
+		                 lambda: self.rx.read_regs(rx_addresses, cached))
+
+	def sync(self):
+		return self.both(self.tx.sync, self.rx.sync)
+
+	def close(self):
+		self.pool.shutdown()
 
 
 #if run, some tests to make sure that it is working
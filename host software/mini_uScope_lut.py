@@ -0,0 +1,61 @@
+import os
+import collections
+import numpy
+import mini_uScope_reconstruction
+
+#============================================================
+#cache for the reconstruction lookup tables.
+#the phase table and pixel map only depend on the mirror configuration (the periodX/periodY config registers of the
+#transmitter, see rxtx_SPI.set_mirror_periods) and the image size, so they are built once per configuration, kept in
+#an LRU in memory, and saved as .npy files that get memory mapped when they are needed again - so restarting, or going
+#back to an earlier period setting, costs a file map instead of a rebuild.
+
+class lut_cache():
+	def __init__(self, directory='lut_cache', maxsize=8):
+		self.directory = directory
+		self.maxsize = maxsize #number of tables kept in memory
+		self.tables = collections.OrderedDict()
+		self.hits = 0 #served from memory
+		self.loads = 0 #mapped from disk
+		self.builds = 0 #computed from scratch
+
+	def get(self, name, build):
+		#name identifies the table, and doubles as its file name; build() makes it if it isn't cached anywhere
+		if name in self.tables:
+			self.tables.move_to_end(name)
+			self.hits = self.hits + 1
+			return self.tables[name]
+
+		path = os.path.join(self.directory, name + '.npy')
+		if os.path.exists(path):
+			table = numpy.load(path, mmap_mode='r')
+			self.loads = self.loads + 1
+		else:
+			table = build()
+			self.builds = self.builds + 1
+			os.makedirs(self.directory, exist_ok=True)
+			#write to a temporary file first, so an interrupted save never leaves a truncated table behind
+			with open(path + '.tmp', 'wb') as f:
+				numpy.save(f, table)
+			os.replace(path + '.tmp', path)
+
+		self.tables[name] = table
+		while len(self.tables) > self.maxsize:
+			self.tables.popitem(last=False)
+		return table
+
+	def phase_table(self, periodX, periodY):
+		name = 'phase_%i_%i'%(periodX, periodY)
+		return self.get(name, lambda: mini_uScope_reconstruction.timer_phase_table(periodX, periodY))
+
+	def pixel_map(self, periodX, periodY, width, height, phaseX=0., phaseY=0.):
+		name = 'pixels_%i_%i_%ix%i_%.6f_%.6f'%(periodX, periodY, width, height, phaseX, phaseY)
+		return self.get(name, lambda: mini_uScope_reconstruction.build_pixel_map(periodX, periodY, width, height, phaseX, phaseY))
+
+	def clear(self, files=False):
+		#forget everything held in memory, and optionally the files on disk as well
+		self.tables.clear()
+		if files and os.path.isdir(self.directory):
+			for name in os.listdir(self.directory):
+				if name.endswith('.npy'):
+					os.remove(os.path.join(self.directory, name))
@@ -5,6 +5,7 @@ from pyftdi.spi import SpiController
 from pyftdi.ftdi import Ftdi
 import numpy
 np = numpy
+import mini_uScope_interfaces
 
 #=====================================================================RX setup
 #class for accessing receiver UWB radio over FTDI FIFO interface.  In normal operation, only FIFO_RX is used to quickly receive large quatities of data;
@@ -94,19 +95,9 @@ if __name__ == "__main__":
 	print(len(data))
 	# print(data[:64])
 
-	#test code: finding place in data stream... well we would not have to do this if we got everything else to work just right, right?  But maybe robustness is better anyway.
-	
-	data2 = numpy.reshape(data[:64*100], [100,64])
-	data_difference = data2[1:,:]-data2[:-1,:]
-	difference_1 = (data_difference == 128)
-	row_totals = numpy.sum(difference_1, axis=0)
-	offset1 = numpy.argmax(row_totals)
-	row_totals[offset1] = 0
-	offset2 = numpy.argmax(row_totals)
-	offset = min(offset1, offset2)-1
-
-	data = data[offset:1000*64+offset]
-	data = numpy.reshape(data, [1000,64])
+	#finding place in data stream: the framer locks onto the timer stamps at the start of each packet, and re-locks if a packet comes up short
+	packets = mini_uScope_interfaces.frame_packets(data)
+	data = packets[:1000].view(numpy.uint8).reshape([-1,64])
 
 	def printfn(x):
 		return str('%03d'%x)
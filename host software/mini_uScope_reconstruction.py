@@ -0,0 +1,295 @@
+import math
+import numpy
+import mini_uScope_interfaces
+
+#============================================================
+#image reconstruction for the lissajous scan.
+#mirror_driver in transmitter.v runs the X and Y axes off two timers with slightly different periods, and every packet is
+#stamped with both timer values.  The pair of timers only repeats after lcm(periodX, periodY) clocks, so the header of
+#a packet tells us exactly where in the full scan (one frame) it was taken - chinese remainder theorem, in table form.
+#each of the 60 samples in the payload is then placed relative to the header by its offset within the packet.
+
+def scan_length(periodX, periodY):
+	#number of clocks in one full scan, i.e. one frame
+	return periodX*periodY//math.gcd(periodX, periodY)
+
+def timer_phase_table(periodX, periodY):
+	#table[timerX*periodY + timerY] is the clock count since the start of the frame for that pair of timer values,
+	#or -1 for pairs that can never happen (which is how corrupted headers show up)
+	L = scan_length(periodX, periodY)
+	t = numpy.arange(L, dtype=numpy.int64)
+	table = numpy.full(periodX*periodY, -1, dtype=numpy.int32)
+	table[(t % periodX)*periodY + t % periodY] = t
+	return table
+
+phase_tables = {} #(periodX, periodY) -> timer_phase_table, for packet_gaps
+
+def header_phases(timerX, timerY, periodX, periodY, table=None):
+	#frame phase of each header, -1 if the header is not a possible timer pair
+	if table is None:
+		if (periodX, periodY) not in phase_tables:
+			phase_tables[(periodX, periodY)] = timer_phase_table(periodX, periodY)
+		table = phase_tables[(periodX, periodY)]
+	timerX = numpy.asarray(timerX, dtype=numpy.int64)
+	timerY = numpy.asarray(timerY, dtype=numpy.int64)
+	valid = (timerX >= 0) & (timerX < periodX) & (timerY >= 0) & (timerY < periodY)
+	t = numpy.full(timerX.shape, -1, dtype=numpy.int64)
+	t[valid] = table[timerX[valid]*periodY + timerY[valid]]
+	return t
+
+def packet_gaps(timerX, timerY, periodX=996, periodY=1000, clocks_per_packet=256, max_gap=16, prev=None, table=None, max_run=4):
+	#exact number of packets lost between received headers.
+	#the pair of timers is a counter over a whole frame, so the clocks between two headers - and with them the number of
+	#packet periods - are known exactly, not just whether the next header follows on.  Packet periods only repeat
+	#after frame_clocks/gcd(clocks_per_packet, frame_clocks) packets (31125 for 996/1000/256, over a second at full
+	#rate), so losses are exact up to that.
+	#corrupted headers: a header that isn't a possible timer pair is ignored.  So is any short run of headers (up to
+	#max_run) with an implausible step in from the last trusted header and an implausible step out to the next - one
+	#that loses a negative number of packets or more than max_gap - when the step straight across the run is plausible,
+	#and a header at either end of an implausible step when the step across it is plausible.
+	#two corrupted headers that happen to agree with each other (the same timer bit flipped in both) would otherwise
+	#look like a loss of nearly a whole cycle.  A real burst of losses has a big step in but a normal step out, so it
+	#survives.  Packets with ignored headers still count as received, and ignoring a good header costs nothing: the
+	#packets lost on either side of it are counted by the longer step across it.
+	#prev chains calls over a stream: pass the 'prev' of the previous result.
+	#returns a dict: received, lost, sent, PER; gaps (packets lost at each step between trusted headers), histogram
+	#(histogram[n] = number of steps that lost n packets), corrupted (ignored headers), trusted (bool per packet),
+	#phases (frame phase per packet, -1 where not trusted) and prev
+	frame_clocks = scan_length(periodX, periodY)
+	g = math.gcd(clocks_per_packet, frame_clocks)
+	cycle = frame_clocks//g #packets before the step counts repeat
+	inverse = pow(clocks_per_packet//g, -1, cycle)
+
+	t = header_phases(timerX, timerY, periodX, periodY, table)
+	n = len(t)
+	#a virtual first header for the last trusted one of the previous call, with the packets received after it
+	if prev is not None and prev[0] >= 0:
+		t = numpy.concatenate([[prev[0]], t])
+		first = 1
+		carried = prev[1]
+	else:
+		first = 0
+		carried = 0
+	trusted = t >= 0
+
+	def steps(a, b):
+		#packet periods from phase a to phase b, -1 if it isn't a whole number
+		d = (b - a) % frame_clocks
+		k = ((d//g)*inverse) % cycle
+		return numpy.where(d % g == 0, k, -1)
+
+	def lost_between(a, b):
+		#packets lost between trusted headers at positions a and b of t; -1 if the step isn't a whole number of packets,
+		#negative if more packets arrived between them than the step has room for
+		k = steps(t[a], t[b])
+		received_between = b - a - 1
+		received_between = received_between + numpy.where((a == 0) & (first == 1), carried, 0)
+		return numpy.where(k > 0, k - 1 - received_between, -1)
+
+	for iteration in range(8):
+		index = numpy.flatnonzero(trusted)
+		if len(index) < 2:
+			break
+		lost = lost_between(index[:-1], index[1:])
+		bad = (lost < 0) | (lost > max_gap)
+		edges = numpy.flatnonzero(bad) #step i goes from header index[i] to index[i+1]
+		if len(edges) == 0:
+			break
+		suspect = numpy.zeros(len(index), dtype=bool)
+		for i, a in enumerate(edges[:-1]):
+			#headers index[a+1..b] sit between two bad steps (with possibly more bad steps among them: corrupted headers
+			#can come in several runs that agree within themselves but not with each other)
+			if edges[i+1] - a == 1:
+				suspect[a+1] = True #a single header: whichever way the step across goes, this one is wrong
+				continue
+			for b in edges[i+1:]:
+				if b - a > max_run:
+					break
+				across = lost_between(index[a:a+1], index[b+1:b+2])[0]
+				if 0 <= across <= max_gap:
+					suspect[a+1:b+1] = True
+					break
+		for e in edges:
+			#a lone bad step: a corrupted header can also land where its other step looks fine (after a few real losses),
+			#so whichever end the step across is plausible without is dropped
+			if suspect[e] or suspect[e+1]:
+				continue
+			if e + 2 < len(index) and 0 <= lost_between(index[e:e+1], index[e+2:e+3])[0] <= max_gap:
+				suspect[e+1] = True
+			elif e >= 1 and 0 <= lost_between(index[e-1:e], index[e+1:e+2])[0] <= max_gap:
+				suspect[e] = True
+		#at the ends there is only one step to go on, so a short run beyond the first or last bad step is blamed.  That
+		#misses a real burst right at the start of a stream; one near the end is still counted by the next call
+		if edges[0] + 1 <= max_run:
+			suspect[:edges[0]+1] = True
+		if len(index) - 1 - edges[-1] <= max_run:
+			suspect[edges[-1]+1:] = True
+		if first == 1:
+			suspect[0] = False #the previous call already trusted it
+		if len(index) - numpy.count_nonzero(suspect) < 1 or not numpy.any(suspect):
+			break
+		trusted[index[suspect]] = False
+
+	index = numpy.flatnonzero(trusted)
+	if len(index) >= 2:
+		k = steps(t[index[:-1]], t[index[1:]])
+		received_between = numpy.diff(index) - 1
+		if first == 1 and index[0] == 0:
+			received_between[0] = received_between[0] + carried
+		gaps = numpy.where(k > 0, numpy.maximum(k - 1 - received_between, 0), 0)
+	else:
+		gaps = numpy.zeros(0, dtype=numpy.int64)
+
+	result = {}
+	result['received'] = n
+	result['lost'] = int(gaps.sum())
+	result['sent'] = n + result['lost']
+	result['PER'] = result['lost']/result['sent'] if result['sent'] > 0 else 0.
+	result['gaps'] = gaps
+	result['histogram'] = numpy.bincount(gaps) if len(gaps) > 0 else numpy.zeros(1, dtype=numpy.int64)
+	result['trusted'] = trusted[first:]
+	result['corrupted'] = n - int(numpy.count_nonzero(result['trusted']))
+	result['phases'] = numpy.where(trusted, t, -1)[first:]
+	if len(index) > 0:
+		result['prev'] = (int(t[index[-1]]), len(t) - 1 - int(index[-1]) + (carried if index[-1] == 0 and first == 1 else 0))
+	elif prev is not None:
+		result['prev'] = (prev[0], prev[1] + n)
+	else:
+		result['prev'] = None
+	return result
+
+def mirror_positions(period, npixels, phase=0.):
+	#pixel coordinate along one axis for each value of that axis' timer.  The mirror is driven at resonance, so its
+	#position is sinusoidal in the timer phase; phase is the (calibrated) lag between the drive signal and the mirror.
+	theta = 2*math.pi*numpy.arange(period)/period + phase
+	return numpy.round((numpy.sin(theta) + 1)/2*(npixels - 1)).astype(numpy.int32)
+
+def build_pixel_map(periodX, periodY, width, height, phaseX=0., phaseY=0.):
+	#flat pixel index (y*width + x) for every clock of one frame; this is the only place any trig happens
+	t = numpy.arange(scan_length(periodX, periodY), dtype=numpy.int64)
+	x = mirror_positions(periodX, width, phaseX)
+	y = mirror_positions(periodY, height, phaseY)
+	return y[t % periodY]*width + x[t % periodX]
+
+
+class image_reconstructor():
+	#turns framed packets (mini_uScope_interfaces.packet_dtype) into images.  Call feed() with packets as they arrive;
+	#it returns a list of any frames completed by them, each a [height, width] array of mean ADC value per pixel
+	#(nan where no sample landed).  Pass a mini_uScope_lut.lut_cache as lut to reuse tables between sessions.
+	def __init__(self, periodX=996, periodY=1000, width=256, height=256, clocks_per_packet=256, clocks_per_sample=2, sample_offset=0, phaseX=0., phaseY=0., lut=None):
+		self.periodX = periodX
+		self.periodY = periodY
+		self.width = width
+		self.height = height
+		self.clocks_per_packet = clocks_per_packet
+		self.frame_clocks = scan_length(periodX, periodY)
+
+		if lut is None:
+			self.phase_table = timer_phase_table(periodX, periodY)
+			self.pixel_map = build_pixel_map(periodX, periodY, width, height, phaseX, phaseY)
+		else:
+			self.phase_table = lut.phase_table(periodX, periodY)
+			self.pixel_map = lut.pixel_map(periodX, periodY, width, height, phaseX, phaseY)
+
+		#clock of each payload sample relative to the header stamp.  The ADC is sampled every other clock (FIFO_in_valid);
+		#sample_offset accounts for the latency through the FIFO and should be calibrated against a known target
+		self.sample_clocks = sample_offset + clocks_per_sample*numpy.arange(mini_uScope_interfaces.payload_size)
+
+		self.sums = numpy.zeros(width*height)
+		self.counts = numpy.zeros(width*height)
+		self.frame = None #frame number currently being accumulated
+		self.last_t = None #frame phase of the last good header
+		self.clock = 0 #running clock count of the last good header
+		self.frames_done = 0
+		self.bad_headers = 0
+		self.received = 0 #packets fed, and packets lost between them, as counted by packet_gaps
+		self.lost = 0
+		self.prev_header = None #for packet_gaps across calls to feed
+
+	def header_phases(self, packets):
+		#frame phase of each packet's header, -1 if the header is not a possible timer pair
+		return header_phases(packets['timerX'], packets['timerY'], self.periodX, self.periodY, self.phase_table)
+
+	def feed(self, packets):
+		#only packets whose header is trusted by packet_gaps are placed: a corrupted header that still happens to be a
+		#possible timer pair would otherwise look like a jump to somewhere else in the frame
+		gaps = packet_gaps(packets['timerX'], packets['timerY'], self.periodX, self.periodY, self.clocks_per_packet, prev=self.prev_header, table=self.phase_table)
+		self.prev_header = gaps['prev']
+		self.received = self.received + gaps['received']
+		self.lost = self.lost + gaps['lost']
+		t = gaps['phases']
+		good = gaps['trusted']
+		self.bad_headers = self.bad_headers + len(t) - numpy.count_nonzero(good)
+		t = t[good]
+		if len(t) == 0:
+			return []
+		values = packets['payload'][good]
+
+		#unwrap the frame phase into a running clock count, so frame boundaries can be found.
+		#assumes less than a whole frame of packets goes missing between two good headers
+		if self.last_t is None:
+			self.last_t = t[0]
+			self.clock = t[0]
+		steps = numpy.diff(t, prepend=self.last_t) % self.frame_clocks
+		clock = self.clock + numpy.cumsum(steps)
+		self.clock = clock[-1]
+		self.last_t = t[-1]
+
+		sample_clock = (clock[:, None] + self.sample_clocks[None, :]).ravel()
+		frame = sample_clock//self.frame_clocks
+		pixels = self.pixel_map[sample_clock % self.frame_clocks]
+		values = values.ravel()
+
+		#samples arrive in time order, so each frame is one contiguous run
+		if self.frame is None:
+			self.frame = frame[0]
+		done = []
+		edges = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(frame)) + 1, [len(frame)]])
+		for start, stop in zip(edges[:-1], edges[1:]):
+			if frame[start] < self.frame:
+				continue #late samples for a frame that is already finished
+			if frame[start] > self.frame:
+				done.append(self.finish_frame())
+				self.frame = frame[start]
+			self.accumulate(pixels[start:stop], values[start:stop])
+		return done
+
+	def accumulate(self, pixels, values):
+		#scatter-add; bincount is by far the fastest way numpy has of doing this
+		npixels = self.width*self.height
+		self.sums += numpy.bincount(pixels, weights=values, minlength=npixels)
+		self.counts += numpy.bincount(pixels, minlength=npixels)
+
+	def current_image(self):
+		#the frame being built, as it stands
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			image = self.sums/self.counts
+		return image.reshape([self.height, self.width])
+
+	def finish_frame(self):
+		image = self.current_image()
+		self.sums = numpy.zeros(self.width*self.height)
+		self.counts = numpy.zeros(self.width*self.height)
+		self.frames_done = self.frames_done + 1
+		return image
+
+
+#if run: check the lost packet count against what the simulator actually dropped, with enough bit errors that plenty of
+#headers are corrupted - some of them consistently with each other - fed whole and in chunks like a live stream
+if __name__ == "__main__":
+	import mini_uScope_simulator
+	for drop_rate, bit_error_rate, seed in [(0.01, 1e-3, 1), (0.01, 1e-3, 2), (0.01, 1e-3, 3), (0., 3e-3, 1), (0.05, 1e-2, 4)]:
+		link = mini_uScope_simulator.sim_link(drop_rate=drop_rate, bit_error_rate=bit_error_rate, seed=seed)
+		packets = link.stream_packets(200000).astype(numpy.int64)
+		timerX = packets[:, 0]*256 + packets[:, 1]
+		timerY = packets[:, 2]*256 + packets[:, 3]
+		whole = packet_gaps(timerX, timerY)['lost']
+		chunked = 0
+		prev = None
+		for i in range(0, len(packets), 1000):
+			gaps = packet_gaps(timerX[i:i+1000], timerY[i:i+1000], prev=prev)
+			prev = gaps['prev']
+			chunked = chunked + gaps['lost']
+		print("drop rate %.2f, BER %.0e: %i dropped, %i counted whole, %i counted in chunks"%(drop_rate, bit_error_rate, link.packets_dropped, whole, chunked))
+		assert abs(whole - link.packets_dropped) <= 0.01*link.packets_dropped + 5
+		assert abs(chunked - link.packets_dropped) <= 0.01*link.packets_dropped + 5
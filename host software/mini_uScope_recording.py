@@ -0,0 +1,258 @@
+import os
+import sys
+import time
+import json
+import numpy
+import mini_uScope_interfaces
+import mini_uScope_reconstruction
+
+#============================================================
+#raw capture recording and replay.
+#a recording is three files sharing a name:
+#	<name>.raw   the bytes exactly as they came out of rx_FIFO, appended chunk by chunk
+#	<name>.idx   one index_dtype record per chunk: where it starts, when it arrived, the first packet edge in it and the
+#	             header timers of that packet, and which register configuration was active
+#	<name>.json  the framing parameters, and the list of register configurations (register shadows of both radios,
+#	             mirror periods) with the byte offset each one took effect at
+#replay memory maps the raw file, so seeking is free and hours of data never have to fit in memory, and hands out the
+#same bytes the live code sees - packet_framer and image_reconstructor don't know the difference.
+#recording while streaming: fifo.start_stream(recorder=recording_writer('capture'))
+
+index_dtype = numpy.dtype([
+	('offset', '<u8'), #byte offset of the chunk in the raw file
+	('length', '<u4'),
+	('time', '<f8'), #unix time the chunk was written
+	('sync', '<i4'), #offset within the chunk of the first packet edge, -1 if alignment couldn't be found
+	('timerX', '<i4'), #header of the packet at sync, -1 if none
+	('timerY', '<i4'),
+	('config', '<i2'), #index into the configurations list of the .json
+])
+
+class recording_writer():
+	#data arrives in whatever pieces the FIFO reader gets, and is written out in chunks of about chunk_size bytes, so
+	#the index stays small (one record per ~0.2 s at the default size) and every chunk is long enough to find the
+	#packet alignment in
+	def __init__(self, path, periodX=996, periodY=1000, clocks_per_packet=256, chunk_size=256*1024, notes=''):
+		self.path = path
+		self.chunk_size = chunk_size
+		self.framer = mini_uScope_interfaces.packet_framer(periodX, periodY, clocks_per_packet)
+		self.config = {'version': 1, 'periodX': periodX, 'periodY': periodY, 'clocks_per_packet': clocks_per_packet,
+		               'packet_size': mini_uScope_interfaces.packet_size, 'start_time': time.time(), 'notes': notes, 'configurations': []}
+		self.raw = open(path + '.raw', 'wb')
+		self.index = open(path + '.idx', 'wb')
+		self.pending = []
+		self.npending = 0
+		self.pending_time = None
+		self.offset = 0 #bytes written to the raw file
+		self.write_config()
+
+	def write_config(self):
+		with open(self.path + '.json.tmp', 'w') as f:
+			json.dump(self.config, f, indent=1)
+		os.replace(self.path + '.json.tmp', self.path + '.json')
+
+	def note_config(self, tx=None, rx=None, **extra):
+		#records the register configuration in effect from here on: the shadow copies of rxtx_SPI tx/rx, their mirror
+		#periods, and anything else given as keyword arguments (e.g. LNA_val=4)
+		self.flush()
+		configuration = {'offset': self.offset + self.npending, 'time': time.time()}
+		if tx is not None:
+			configuration['tx'] = {str(a): v for a, v in sorted(tx.shadow.items())}
+			configuration['periods'] = list(tx.mirror_periods())
+		if rx is not None:
+			configuration['rx'] = {str(a): v for a, v in sorted(rx.shadow.items())}
+		configuration.update(extra)
+		self.config['configurations'].append(configuration)
+		self.write_config()
+
+	def write(self, data):
+		if len(data) == 0:
+			return
+		if self.pending_time is None:
+			self.pending_time = time.time()
+		self.pending.append(bytes(data))
+		self.npending = self.npending + len(data)
+		if self.npending >= self.chunk_size:
+			self.flush()
+
+	def flush(self):
+		if self.npending == 0:
+			return
+		chunk = numpy.frombuffer(b''.join(self.pending), dtype=numpy.uint8)
+		record = numpy.zeros(1, dtype=index_dtype)
+		record['offset'] = self.offset
+		record['length'] = len(chunk)
+		record['time'] = self.pending_time
+		record['sync'] = -1
+		record['timerX'] = -1
+		record['timerY'] = -1
+		record['config'] = len(self.config['configurations']) - 1
+		if len(chunk) >= mini_uScope_interfaces.packet_size*(self.framer.lock_packets + 3):
+			sync = self.framer.find_offset(chunk)
+			if sync >= 0:
+				record['sync'] = sync
+				record['timerX'] = int(chunk[sync])*256 + int(chunk[sync+1])
+				record['timerY'] = int(chunk[sync+2])*256 + int(chunk[sync+3])
+		self.raw.write(chunk.tobytes())
+		self.raw.flush()
+		self.index.write(record.tobytes())
+		self.index.flush()
+		self.offset = self.offset + len(chunk)
+		self.pending = []
+		self.npending = 0
+		self.pending_time = None
+
+	def close(self):
+		self.flush()
+		self.config['end_time'] = time.time()
+		self.config['bytes'] = self.offset
+		self.write_config()
+		self.raw.close()
+		self.index.close()
+
+
+class recording_reader():
+	def __init__(self, path):
+		self.path = path
+		with open(path + '.json') as f:
+			self.config = json.load(f)
+		self.periodX = self.config['periodX']
+		self.periodY = self.config['periodY']
+		self.clocks_per_packet = self.config['clocks_per_packet']
+		self.index = numpy.fromfile(path + '.idx', dtype=index_dtype)
+		#a recording cut short by a crash can have raw data past the last index record; it is still readable
+		size = os.path.getsize(path + '.raw')
+		self.data = numpy.memmap(path + '.raw', dtype=numpy.uint8, mode='r') if size > 0 else numpy.zeros(0, dtype=numpy.uint8)
+		self.chunk_clocks = None #from unwrap_clocks, only worked out when a frame seek needs it
+
+	def __len__(self):
+		return len(self.data)
+
+	def duration(self):
+		if len(self.index) == 0:
+			return 0.
+		return float(self.index['time'][-1] - self.index['time'][0])
+
+	def unwrap_clocks(self):
+		#running clock count of the sync packet of each chunk, from the header timers at the chunk boundaries.
+		#the timers only give the phase within a frame, so the number of whole frames between two chunks comes from the
+		#wall time between them, at the clock rate the recording itself runs at (median over all chunks, so bursts of
+		#dropped packets don't skew it).  -1 where a chunk had no sync
+		frame_clocks = mini_uScope_reconstruction.scan_length(self.periodX, self.periodY)
+		phase_table = mini_uScope_reconstruction.timer_phase_table(self.periodX, self.periodY)
+		clocks = numpy.full(len(self.index), -1, dtype=numpy.int64)
+		good = numpy.flatnonzero((self.index['sync'] >= 0) & (self.index['timerX'] < self.periodX) & (self.index['timerY'] < self.periodY))
+		if len(good) == 0:
+			return clocks
+		phase = phase_table[self.index['timerX'][good].astype(numpy.int64)*self.periodY + self.index['timerY'][good]].astype(numpy.int64)
+		keep = phase >= 0
+		good = good[keep]
+		phase = phase[keep]
+		if len(good) == 0:
+			return clocks
+		position = (self.index['offset'][good] + self.index['sync'][good]).astype(numpy.int64)
+		times = self.index['time'][good]
+		if len(good) > 1:
+			rates = numpy.diff(position)/mini_uScope_interfaces.packet_size*self.clocks_per_packet/numpy.maximum(numpy.diff(times), 1e-6)
+			clock_rate = numpy.median(rates)
+		else:
+			clock_rate = 0.
+		clock = numpy.zeros(len(good), dtype=numpy.int64)
+		clock[0] = phase[0]
+		for i in range(1, len(good)):
+			estimate = clock[i-1] + clock_rate*(times[i] - times[i-1])
+			step = (phase[i] - clock[i-1]) % frame_clocks
+			clock[i] = clock[i-1] + step + frame_clocks*int(round((estimate - clock[i-1] - step)/frame_clocks))
+		clocks[good] = clock
+		return clocks
+
+	def packet_offset(self, offset):
+		#the packet edge at or after a byte offset, using the sync of the chunk it falls in
+		if len(self.index) == 0:
+			return offset
+		k = max(numpy.searchsorted(self.index['offset'], offset, side='right') - 1, 0)
+		if self.index['sync'][k] < 0:
+			return offset
+		edge = int(self.index['offset'][k]) + int(self.index['sync'][k])
+		return edge + -(-(offset - edge)//mini_uScope_interfaces.packet_size)*mini_uScope_interfaces.packet_size
+
+	def seek_time(self, t):
+		#byte offset of the first packet at least t seconds into the recording
+		if len(self.index) == 0:
+			return 0
+		t = self.index['time'][0] + t
+		k = max(numpy.searchsorted(self.index['time'], t, side='right') - 1, 0)
+		offset = int(self.index['offset'][k])
+		if k + 1 < len(self.index) and self.index['time'][k+1] > self.index['time'][k]:
+			#interpolate within the chunk
+			fraction = (t - self.index['time'][k])/(self.index['time'][k+1] - self.index['time'][k])
+			offset = offset + int(min(max(fraction, 0.), 1.)*self.index['length'][k])
+		return self.packet_offset(min(offset, len(self.data)))
+
+	def seek_frame(self, n):
+		#byte offset of (about) the first packet of frame n, counting the frame the recording starts in as 0.
+		#exact to within the packets dropped since the start of the chunk
+		frame_clocks = mini_uScope_reconstruction.scan_length(self.periodX, self.periodY)
+		if self.chunk_clocks is None:
+			self.chunk_clocks = self.unwrap_clocks()
+		good = numpy.flatnonzero(self.chunk_clocks >= 0)
+		if len(good) == 0:
+			return 0
+		first_frame = self.chunk_clocks[good[0]]//frame_clocks
+		target = (first_frame + n)*frame_clocks
+		k = good[max(numpy.searchsorted(self.chunk_clocks[good], target, side='right') - 1, 0)]
+		packets = max(target - self.chunk_clocks[k], 0)//self.clocks_per_packet
+		offset = int(self.index['offset'][k]) + int(self.index['sync'][k]) + int(packets)*mini_uScope_interfaces.packet_size
+		return min(offset, len(self.data))
+
+	def read(self, start=0, stop=None):
+		#zero copy view of the raw bytes
+		return self.data[start:stop]
+
+	def chunks(self, start=0, stop=None, size=2**20):
+		#views of the raw bytes from start to stop, size bytes at a time, the way a live stream would hand them out
+		if stop is None:
+			stop = len(self.data)
+		for i in range(start, stop, size):
+			yield self.data[i:min(i + size, stop)]
+
+	def packets(self, start=0, stop=None, size=2**20):
+		#framed packets (mini_uScope_interfaces.packet_dtype), through the same packet_framer the live code uses
+		framer = mini_uScope_interfaces.packet_framer(self.periodX, self.periodY, self.clocks_per_packet)
+		for chunk in self.chunks(start, stop, size):
+			packets = framer.feed(chunk)
+			if len(packets) > 0:
+				yield packets
+		packets = framer.flush()
+		if len(packets) > 0:
+			yield packets
+
+	def frames(self, start=0, stop=None, width=256, height=256, lut=None, **kwargs):
+		#completed images, through image_reconstructor; kwargs go to its constructor (phases, sample_offset...)
+		reconstructor = mini_uScope_reconstruction.image_reconstructor(self.periodX, self.periodY, width, height, self.clocks_per_packet, lut=lut, **kwargs)
+		for packets in self.packets(start, stop):
+			for image in reconstructor.feed(packets):
+				yield image
+
+
+def record(fifo, path, seconds, tx=None, rx=None, **kwargs):
+	#records seconds of the reciever's stream; kwargs go to recording_writer
+	periods = tx.mirror_periods() if tx is not None else (996, 1000)
+	recorder = recording_writer(path, periods[0], periods[1], **kwargs)
+	recorder.note_config(tx, rx)
+	fifo.start_stream(recorder=recorder)
+	time.sleep(seconds)
+	fifo.stop_stream()
+	recorder.close()
+	return recorder
+
+
+#if run: summary of a recording, e.g.  python mini_uScope_recording.py capture
+if __name__ == "__main__":
+	reader = recording_reader(sys.argv[1])
+	print("%i bytes, %i chunks, %.1f s, %i configurations"%(len(reader), len(reader.index), reader.duration(), len(reader.config['configurations'])))
+	clocks = reader.unwrap_clocks()
+	good = clocks >= 0
+	if numpy.any(good):
+		frame_clocks = mini_uScope_reconstruction.scan_length(reader.periodX, reader.periodY)
+		print("frames %i to %i"%(clocks[good][0]//frame_clocks, clocks[good][-1]//frame_clocks))
@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import pickle
+import numpy
+
+#============================================================
+#columnar store for sweep results.
+#a store is a directory holding one raw binary file per column (<name>.bin) and a schema.json describing them.
+#rows are appended as they are measured, and analysis memory-maps just the columns it needs, so querying one
+#column of a big archive never has to unpickle anything.
+
+result_fields = [
+	('LNA', numpy.int16),
+	('filt_freq', numpy.int16),
+	('pulse_freq', numpy.int16),
+	('pulse_config', numpy.uint16), #bitmask of the twelve pulse registers: bit j set means pulse j is on
+	('BER', numpy.float64),
+	('PER', numpy.float64),
+	('RSSI', numpy.int16),
+	('RNSI', numpy.int16),
+	('time_start', numpy.float64), #unix time the point was started and finished
+	('time_end', numpy.float64),
+	('config_hash', numpy.uint64), #identifies the point and the sweep settings, for resuming (mini_uScope_sweep.sweep_runner); 0 if unknown
+]
+
+def missing_value(dtype):
+	#what a column holds when a value was never measured
+	if numpy.dtype(dtype).kind == 'f':
+		return numpy.nan
+	return -1 if numpy.dtype(dtype).kind == 'i' else 0
+
+def pulse_mask(pulse_config):
+	#[1,2,3] -> 0b1110
+	mask = 0
+	for j in pulse_config:
+		mask = mask | (1 << j)
+	return mask
+
+def pulse_list(mask):
+	return [j for j in range(12) if (int(mask) >> j) % 2 == 1]
+
+
+class result_store():
+	def __init__(self, directory, fields=result_fields):
+		self.directory = directory
+		os.makedirs(directory, exist_ok=True)
+		if os.path.exists(self.schema_path()):
+			with open(self.schema_path()) as f:
+				schema = json.load(f)
+			self.fields = [(name, numpy.dtype(dtype)) for name, dtype in schema['fields']]
+		else:
+			self.fields = []
+		added = [(name, numpy.dtype(dtype)) for name, dtype in fields if name not in dict(self.fields)]
+		self.handles = {}
+
+		#a crash part way through an append can leave some columns one row longer than others; the shortest one wins
+		sizes = [os.path.getsize(self.path(name))//dtype.itemsize if os.path.exists(self.path(name)) else 0 for name, dtype in self.fields]
+		self.length = min(sizes) if len(sizes) > 0 else 0
+		for (name, dtype), size in zip(self.fields, sizes):
+			if size > self.length:
+				with open(self.path(name), 'r+b') as f:
+					f.truncate(self.length*dtype.itemsize)
+
+		#fields that are newer than the store get a column of missing values for the rows already in it
+		for name, dtype in added:
+			numpy.full(self.length, missing_value(dtype), dtype=dtype).tofile(self.path(name))
+			self.fields.append((name, dtype))
+		if len(added) > 0:
+			with open(self.schema_path(), 'w') as f:
+				json.dump({'version': 1, 'fields': [(name, dtype.str) for name, dtype in self.fields]}, f, indent=1)
+		self.dtypes = dict(self.fields)
+
+	def schema_path(self):
+		return os.path.join(self.directory, 'schema.json')
+
+	def path(self, name):
+		return os.path.join(self.directory, name + '.bin')
+
+	def __len__(self):
+		return self.length
+
+	def append(self, result):
+		#result is a dict keyed by field name; missing fields are stored as missing, and a pulse_config given as a list of
+		#pulse indices is converted to a bitmask.  Each row is flushed to disk before returning.
+		self.extend({name: [value] for name, value in result.items()})
+
+	def extend(self, columns):
+		#appends many rows at once: {name: sequence}, all the same length
+		columns = dict(columns)
+		if 'pulse_config' in columns:
+			columns['pulse_config'] = [pulse_mask(v) if isinstance(v, (list, tuple)) else v for v in columns['pulse_config']]
+		n = len(next(iter(columns.values())))
+		for name, dtype in self.fields:
+			if name in columns:
+				values = numpy.asarray(columns[name], dtype=dtype)
+			else:
+				values = numpy.full(n, missing_value(dtype), dtype=dtype)
+			if name not in self.handles:
+				self.handles[name] = open(self.path(name), 'ab')
+			self.handles[name].write(values.tobytes())
+		for handle in self.handles.values():
+			handle.flush()
+		self.length = self.length + n
+
+	def column(self, name):
+		#read-only memory map of one column
+		if self.length == 0:
+			return numpy.zeros(0, dtype=self.dtypes[name])
+		return numpy.memmap(self.path(name), dtype=self.dtypes[name], mode='r', shape=(self.length,))
+
+	def columns(self, names=None):
+		if names is None:
+			names = [name for name, dtype in self.fields]
+		return {name: self.column(name) for name in names}
+
+	def row(self, i):
+		#one row as a result dict, the way it was appended (pulse_config as a list of pulse indices)
+		result = {name: self.column(name)[i].item() for name, dtype in self.fields}
+		if 'pulse_config' in result:
+			result['pulse_config'] = pulse_list(result['pulse_config'])
+		return result
+
+	def records(self):
+		#copy of the whole store as a structured array, convenient for small stores
+		records = numpy.zeros(self.length, dtype=self.fields)
+		for name, dtype in self.fields:
+			records[name] = self.column(name)
+		return records
+
+	def close(self):
+		for handle in self.handles.values():
+			handle.close()
+		self.handles = {}
+
+
+def import_pickle(path, store):
+	#imports an old pickled result list into a store; returns the number of rows added.  Understands:
+	#  list of dicts, from scan_rf_performance.py: LNA, filt_freq, pulse_freq, BER, PER, RSSI, pulse_config
+	#  7 element lists, from FTDI SR10x0 test.py: [pulse_config, pulse_freq, rx_filt_freq, drop_rate, ber, rssi, rnsi]
+	#  6 element lists, from older versions of it: [pulse_config, pulse_freq, rx_filt_freq, drop_rate, ?, byte error rate]
+	#the old files have no timestamps, so the file's modification time is used; LNA was always 4 in the list formats
+	with open(path, 'rb') as f:
+		results = pickle.load(f)
+	mtime = os.path.getmtime(path)
+	rows = []
+	for result in results:
+		if isinstance(result, dict):
+			row = {name: result[name] for name in ['LNA', 'filt_freq', 'pulse_freq', 'BER', 'PER', 'RSSI', 'RNSI'] if name in result}
+			row['pulse_config'] = pulse_mask(result['pulse_config'])
+		elif len(result) == 7:
+			row = {'LNA': 4, 'pulse_config': pulse_mask(result[0]), 'pulse_freq': result[1], 'filt_freq': result[2], 'PER': result[3], 'BER': result[4], 'RSSI': result[5], 'RNSI': result[6]}
+		elif len(result) == 6:
+			row = {'LNA': 4, 'pulse_config': pulse_mask(result[0]), 'pulse_freq': result[1], 'filt_freq': result[2], 'PER': result[3], 'BER': result[5]/8.}
+		else:
+			raise ValueError("unrecognised result format in %s: %s"%(path, result))
+		row['time_start'] = mtime
+		row['time_end'] = mtime
+		rows.append(row)
+	if len(rows) == 0:
+		return 0
+	names = set().union(*rows)
+	store.extend({name: [row.get(name, missing_value(store.dtypes[name])) for row in rows] for name in names})
+	return len(rows)
+
+
+#if run: import pickled results into a store, e.g.  python mini_uScope_results.py results_store quality_results*.pkl
+if __name__ == "__main__":
+	store = result_store(sys.argv[1])
+	for path in sys.argv[2:]:
+		print("%s: %i results"%(path, import_pickle(path, store)))
+	store.close()
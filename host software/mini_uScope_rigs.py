@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import queue
+import argparse
+import multiprocessing
+import mini_uScope_interfaces
+
+#============================================================
+#several microscope/reciever pairs ("rigs") on one host.
+#every rig is a transmitter FT232H, a reciever FT2232H and the reciever's FIFO channel, each picked by USB serial
+#number from a registry (rigs.json), and each rig runs in a process of its own: its USB reads, framing and error
+#counting never share a GIL with another rig's, so one rig falling behind can't starve the others' FIFO reads.
+#the processes report their health (data rate, lost packets, BER against the test pattern, host buffer backlog) over a
+#queue, and rig_orchestrator keeps the latest report of each, plus the totals.
+#	python mini_uScope_rigs.py list                      (serial numbers of everything plugged in)
+#	python mini_uScope_rigs.py add scope1 --tx FT1AAAA --rx FT2BBBB --fifo FT2BBBBB
+#	python mini_uScope_rigs.py run --seconds 60 --record data/
+#	python mini_uScope_rigs.py run --sim 4              (four simulated rigs)
+#	python mini_uScope_rigs.py check                    (simulated rigs with known drop rates, checks the reported PER)
+
+default_registry = 'rigs.json'
+
+def load_rigs(path=default_registry):
+	#{name: rig}; a rig is {'tx': serial, 'rx': serial, 'fifo': D2XX serial of the FIFO channel, 'periods': [X, Y]},
+	#or {'sim': {sim_link arguments}} for a simulated one
+	if not os.path.exists(path):
+		return {}
+	with open(path) as f:
+		return json.load(f)
+
+def save_rigs(rigs, path=default_registry):
+	with open(path + '.tmp', 'w') as f:
+		json.dump(rigs, f, indent=1)
+	os.replace(path + '.tmp', path)
+
+def open_rig(rig):
+	#a link_session (with fifo) on the rig's devices
+	if 'sim' in rig:
+		import mini_uScope_simulator
+		session = mini_uScope_simulator.sim_session(**rig['sim'])
+	else:
+		tx = mini_uScope_interfaces.rxtx_SPI('tx', serial=rig['tx'])
+		rx = mini_uScope_interfaces.rxtx_SPI('rx', serial=rig['rx'])
+		fifo = mini_uScope_interfaces.rx_FIFO(serial=rig['fifo'])
+		session = mini_uScope_interfaces.link_session(tx, rx, fifo)
+	if 'periods' in rig:
+		session.tx.set_mirror_periods(*rig['periods'])
+	return session
+
+
+def rig_process(name, rig, status_queue, stop, seconds=None, record_dir=None, report_interval=1., config={}):
+	#body of a rig's process: open, configure, stream and count until stop is set (or for seconds), reporting every
+	#report_interval.  Anything that goes wrong is reported rather than raised, so the other rigs carry on
+	import mini_uScope_analysis
+	import mini_uScope_recording
+	session = None
+	recorder = None
+	report = {'rig': name, 'pid': os.getpid(), 'state': 'starting', 'time': time.time()}
+	status_queue.put(dict(report))
+	try:
+		session = open_rig(rig)
+		session.config_UWB(**config)
+		periodX, periodY = session.tx.mirror_periods()
+		if record_dir is not None:
+			recorder = mini_uScope_recording.recording_writer(os.path.join(record_dir, name), periodX, periodY)
+			recorder.note_config(session.tx, session.rx)
+		estimator = mini_uScope_analysis.link_estimator(periodX=periodX, periodY=periodY)
+		stream = session.fifo.start_stream(recorder=recorder)
+		report['state'] = 'running'
+
+		start = time.time()
+		last_report = start
+		nbytes = 0
+		last = {'bytes': 0, 'bits': 0, 'bit_errors': 0, 'packets': 0, 'lost': 0}
+		while not stop.is_set() and (seconds is None or time.time() - start < seconds):
+			if stream.wait(mini_uScope_interfaces.packet_size, timeout=0.1):
+				view = stream.peek()
+				estimator.feed(view)
+				nbytes = nbytes + len(view)
+				stream.release(len(view))
+			now = time.time()
+			if now - last_report >= report_interval:
+				#rates over the last interval, totals since the start
+				counts = {'bytes': nbytes, 'bits': estimator.bits, 'bit_errors': estimator.bit_errors, 'packets': estimator.packets, 'lost': estimator.lost}
+				delta = {k: counts[k] - last[k] for k in counts}
+				report.update(counts)
+				report['time'] = now
+				report['byte_rate'] = delta['bytes']/(now - last_report)
+				report['PER'] = delta['lost']/delta['packets'] if delta['packets'] > 0 else 1. #packets counts the lost ones too
+				report['BER'] = delta['bit_errors']/delta['bits'] if delta['bits'] > 0 else 1.
+				report['backlog'] = stream.available()
+				report['ring_dropped'] = stream.dropped
+				status_queue.put(dict(report))
+				last = counts
+				last_report = now
+		session.fifo.stop_stream()
+		report['state'] = 'stopped'
+	except Exception as e:
+		report['state'] = 'error'
+		report['error'] = "%s: %s"%(type(e).__name__, e)
+	finally:
+		if recorder is not None:
+			recorder.close()
+		if session is not None:
+			session.close()
+		report['time'] = time.time()
+		status_queue.put(dict(report))
+
+
+class rig_orchestrator():
+	#runs rig_process for each of rigs ({name: rig}).  Processes are spawned rather than forked, so none of them
+	#inherits USB handles or reader threads from this one.  poll() collects reports into self.health
+	def __init__(self, rigs, config={}, record_dir=None, report_interval=1.):
+		self.rigs = rigs
+		self.config = config
+		self.record_dir = record_dir
+		self.report_interval = report_interval
+		self.context = multiprocessing.get_context('spawn')
+		self.status_queue = self.context.Queue()
+		self.stop_event = self.context.Event()
+		self.processes = {}
+		self.health = {name: {'rig': name, 'state': 'idle'} for name in rigs}
+
+	def start(self, seconds=None):
+		if self.record_dir is not None and not os.path.exists(self.record_dir):
+			os.makedirs(self.record_dir)
+		for name, rig in self.rigs.items():
+			process = self.context.Process(target=rig_process, name=name, daemon=True,
+			                               args=(name, rig, self.status_queue, self.stop_event, seconds, self.record_dir, self.report_interval, self.config))
+			process.start()
+			self.processes[name] = process
+
+	def poll(self, timeout=0.5):
+		#waits up to timeout for reports, takes all that are waiting; returns the names of the rigs that reported
+		updated = []
+		try:
+			report = self.status_queue.get(timeout=timeout)
+			while True:
+				self.health[report['rig']] = report
+				updated.append(report['rig'])
+				report = self.status_queue.get_nowait()
+		except queue.Empty:
+			pass
+		#a process that died without saying so (killed, crashed in a driver) is an error too
+		for name, process in self.processes.items():
+			if not process.is_alive() and self.health[name]['state'] in ['idle', 'starting', 'running'] and self.status_queue.empty():
+				self.health[name] = dict(self.health[name], state='error', error="process exited with code %s"%process.exitcode)
+		return updated
+
+	def running(self):
+		return any(process.is_alive() for process in self.processes.values())
+
+	def aggregate(self):
+		#totals over all rigs.  The data rate is only that of the rigs still running: a stopped or failed rig's last
+		#report still holds the rate it had before it stopped
+		reports = list(self.health.values())
+		total = {'rigs': len(reports), 'running': sum(r['state'] == 'running' for r in reports), 'errors': sum(r['state'] == 'error' for r in reports)}
+		total['byte_rate'] = sum(r.get('byte_rate', 0) for r in reports if r['state'] == 'running')
+		for name in ['bytes', 'packets', 'lost', 'ring_dropped']:
+			total[name] = sum(r.get(name, 0) for r in reports)
+		total['PER'] = total['lost']/total['packets'] if total['packets'] > 0 else 0.
+		return total
+
+	def summary(self):
+		lines = []
+		for name in sorted(self.health):
+			r = self.health[name]
+			if r['state'] == 'error':
+				lines.append("%-12s error: %s"%(name, r.get('error', '')))
+			else:
+				lines.append("%-12s %-8s %7.2f MB/s  PER %.4f  BER %.2e  backlog %.1f kB  overrun %.1f kB"%(name, r['state'], r.get('byte_rate', 0.)/1e6, r.get('PER', 0.), r.get('BER', 0.), r.get('backlog', 0)/1e3, r.get('ring_dropped', 0)/1e3))
+		total = self.aggregate()
+		lines.append("%i/%i rigs running, %.2f MB/s total, PER %.4f, %i errors"%(total['running'], total['rigs'], total['byte_rate']/1e6, total['PER'], total['errors']))
+		return "\n".join(lines)
+
+	def stop(self, timeout=5.):
+		self.stop_event.set()
+		for process in self.processes.values():
+			process.join(timeout)
+			if process.is_alive():
+				process.terminate()
+		self.poll(timeout=0.1)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="run several microscope/reciever pairs from one host")
+	parser.add_argument('--registry', default=default_registry, help="rig registry file")
+	commands = parser.add_subparsers(dest='command', required=True)
+	commands.add_parser('list', help="list the FTDI devices that can be seen, with their serial numbers")
+	add = commands.add_parser('add', help="add a rig to the registry (or change one)")
+	add.add_argument('name')
+	add.add_argument('--tx', required=True, help="serial number of the transmitter's FT232H")
+	add.add_argument('--rx', required=True, help="serial number of the reciever's FT2232H")
+	add.add_argument('--fifo', required=True, help="D2XX serial number of the reciever's FIFO channel")
+	add.add_argument('--periods', type=int, nargs=2, default=[996, 1000], help="mirror timer periods (periodX periodY)")
+	run = commands.add_parser('run', help="stream from rigs until ctrl-c (or for --seconds)")
+	run.add_argument('names', nargs='*', help="rigs to run (default: all in the registry)")
+	run.add_argument('--seconds', type=float, default=None)
+	run.add_argument('--record', default=None, help="directory to record each rig's raw stream into")
+	run.add_argument('--interval', type=float, default=1., help="seconds between health reports")
+	run.add_argument('--sim', type=int, default=0, help="run this many simulated rigs instead of the registry")
+	check = commands.add_parser('check', help="run simulated rigs with known drop rates and check the PER they report")
+	check.add_argument('--seconds', type=float, default=3.)
+	args = parser.parse_args()
+
+	if args.command == 'list':
+		for device in mini_uScope_interfaces.list_devices():
+			print("%-7s %-12s %-24s %s"%(device['driver'], device['serial'], device['description'], device['type']))
+	elif args.command == 'check':
+		drop_rates = [0., 0.1, 0.5]
+		rigs = {'sim%i'%i: {'sim': {'drop_rate': drop_rate, 'seed': i}} for i, drop_rate in enumerate(drop_rates)}
+		orchestrator = rig_orchestrator(rigs)
+		orchestrator.start(args.seconds)
+		while orchestrator.running():
+			orchestrator.poll()
+		orchestrator.stop()
+		print(orchestrator.summary())
+		for i, drop_rate in enumerate(drop_rates):
+			report = orchestrator.health['sim%i'%i]
+			PER = report['lost']/report['packets']
+			print("sim%i: drop rate %.2f, PER %.4f over %i packets"%(i, drop_rate, PER, report['packets']))
+			assert report['state'] == 'stopped' and abs(PER - drop_rate) < 0.02
+		total = orchestrator.aggregate()
+		expected = sum(drop_rate*orchestrator.health['sim%i'%i]['packets'] for i, drop_rate in enumerate(drop_rates))/total['packets']
+		print("total: PER %.4f, expected %.4f"%(total['PER'], expected))
+		assert abs(total['PER'] - expected) < 0.02
+	elif args.command == 'add':
+		rigs = load_rigs(args.registry)
+		rigs[args.name] = {'tx': args.tx, 'rx': args.rx, 'fifo': args.fifo, 'periods': args.periods}
+		save_rigs(rigs, args.registry)
+	else:
+		if args.sim > 0:
+			rigs = {'sim%i'%i: {'sim': {'drop_rate': 0.01, 'bit_error_rate': 1e-5, 'seed': i}} for i in range(args.sim)}
+		else:
+			rigs = load_rigs(args.registry)
+			if len(args.names) > 0:
+				rigs = {name: rigs[name] for name in args.names}
+		orchestrator = rig_orchestrator(rigs, record_dir=args.record, report_interval=args.interval)
+		orchestrator.start(args.seconds)
+		try:
+			while orchestrator.running():
+				if orchestrator.poll(timeout=args.interval):
+					print(orchestrator.summary() + "\n")
+		except KeyboardInterrupt:
+			pass
+		orchestrator.stop()
+		print(orchestrator.summary())
@@ -0,0 +1,316 @@
+import time
+import threading
+import numpy
+import mini_uScope_interfaces
+
+#============================================================
+#software stand-in for the hardware, so the host side (framing, BER, reconstruction, sweeps) can be run and load
+#tested with no boards attached.  sim_link holds the shared state - both radios, the transmitter's mirror timers and
+#the link impairments - and hands out drop-in devices:
+#	tx = mini_uScope_interfaces.rxtx_SPI('tx', slave=link.spi_port('tx'))
+#	rx = mini_uScope_interfaces.rxtx_SPI('rx', slave=link.spi_port('rx'))
+#	fifo = mini_uScope_interfaces.rx_FIFO(dev=link.fifo_device())
+#or all three at once with sim_session().  Packets follow uwb_packet_writer in transmitter.v: a big endian timerX,
+#timerY header and 60 ADC samples, one packet every clocks_per_packet clocks.
+
+class sim_radio():
+	#SR10x0 register file, as seen through UWB transactions: [command, data...], where command is the address, +64 for
+	#a write and +128 for a burst (consecutive addresses, except for the FIFO at 0x3F which stays put).
+	#registers 2 and 3 read back the TX and RX FIFO fill, and 0x22/0x23 (RSSI/RNSI) are set by the link
+	def __init__(self, link=None):
+		self.link = link
+		self.regs = bytearray(64)
+		self.tx_fifo = bytearray()
+		self.rx_fifo = bytearray()
+		self.fifo_size = 128
+		self.overflows = 0 #bytes lost to a full FIFO
+		self.lock = threading.RLock()
+
+	def transaction(self, payload):
+		with self.lock:
+			command = payload[0]
+			address = command & 63
+			reply = [self.regs[1]] #status byte, clocked out during the command byte
+			for i, value in enumerate(payload[1:]):
+				a = address
+				if command & 128 and address != 0x3F:
+					a = (address + i) & 63
+				if command & 64:
+					self.write(a, value)
+					reply.append(0)
+				else:
+					reply.append(self.read(a))
+			return reply
+
+	def write(self, address, value):
+		if address == 0x3F:
+			if len(self.tx_fifo) >= self.fifo_size:
+				self.overflows = self.overflows + 1
+				return
+			self.tx_fifo.append(value)
+			packet_length = self.regs[0x3C] if self.regs[0x3C] > 0 else 64
+			if self.link is not None and len(self.tx_fifo) >= packet_length:
+				packet = bytes(self.tx_fifo[:packet_length])
+				del self.tx_fifo[:packet_length]
+				self.link.deliver(self, packet)
+			return
+		self.regs[address] = value
+		if self.link is not None:
+			self.link.config_changed()
+
+	def read(self, address):
+		if address == 0x3F:
+			if len(self.rx_fifo) == 0:
+				return 0
+			value = self.rx_fifo[0]
+			del self.rx_fifo[0]
+			return value
+		if address == 2:
+			return min(len(self.tx_fifo), 255)
+		if address == 3:
+			return min(len(self.rx_fifo), 255)
+		return self.regs[address]
+
+	def receive(self, packet):
+		with self.lock:
+			room = self.fifo_size - len(self.rx_fifo)
+			self.rx_fifo += packet[:room]
+			self.overflows = self.overflows + max(len(packet) - room, 0)
+
+
+class sim_spi_port():
+	#stands in for the pyftdi SpiPort used by rxtx_SPI: the config byte pass-through to the radio (config byte 6), plus
+	#the FPGA's own 4 byte [command, address, MSB, LSB] config registers, whose read response comes out one transfer later
+	def __init__(self, radio, cfg_regs=None):
+		self.radio = radio
+		self.cfg_regs = cfg_regs if cfg_regs is not None else {}
+		self.config_byte = 1
+		self.cfg_response = bytes(4)
+		self.transfers = 0
+
+	def exchange(self, out=b'', readlen=0, start=True, stop=True, duplex=False, droptail=0):
+		out = bytes(out)
+		self.transfers = self.transfers + 1
+		if len(out) == 1:
+			reply = bytes([self.config_byte])
+			self.config_byte = out[0]
+		elif len(out) > 1 and out[0] == 6:
+			reply = bytes([6] + self.radio.transaction(out[1:]))
+		elif len(out) == 4:
+			reply = self.cfg_response
+			if out[0] == 1:
+				self.cfg_regs[out[1]] = out[2]*256 + out[3]
+			elif out[0] == 2:
+				value = self.cfg_regs.get(out[1], 0)
+				self.cfg_response = bytes([0, 0, value >> 8, value & 255])
+		else:
+			reply = bytes(len(out))
+		if readlen == 0:
+			readlen = len(out)
+		return reply[:readlen] + bytes(max(readlen - len(reply), 0))
+
+	def write(self, out, start=True, stop=True, droptail=0):
+		self.exchange(out)
+
+	def read(self, readlen=0, start=True, stop=True, droptail=0):
+		return self.exchange(bytes(readlen), readlen)
+
+
+class sim_fifo_device():
+	#stands in for the ftd2xx device used by rx_FIFO.  Packets accumulate at the link's byte rate in wall clock time,
+	#into a driver queue of queue_size bytes; whatever doesn't fit is lost, as it would be on the real FT2232H when the
+	#host falls behind.  Writes are FIFO-channel register transfers ([length, UWB bytes...]) and their replies are
+	#queued into the stream the same way the reciever FPGA does it.
+	def __init__(self, link, queue_size=2**20):
+		self.link = link
+		self.queue = bytearray()
+		self.queue_size = queue_size
+		self.overflows = 0 #bytes lost to a full queue
+		self.last_time = time.time()
+		self.lock = threading.Lock()
+
+	def update(self):
+		now = time.time()
+		nbytes = self.link.byte_rate*(now - self.last_time)
+		npackets = int(nbytes//mini_uScope_interfaces.packet_size)
+		if npackets == 0:
+			return
+		self.last_time = self.last_time + npackets*mini_uScope_interfaces.packet_size/self.link.byte_rate
+		data = self.link.stream_bytes(npackets)
+		room = self.queue_size - len(self.queue)
+		self.queue += data[:room]
+		self.overflows = self.overflows + max(len(data) - room, 0)
+
+	def getQueueStatus(self):
+		with self.lock:
+			self.update()
+			return len(self.queue)
+
+	def read(self, nbytes):
+		with self.lock:
+			data = bytes(self.queue[:nbytes])
+			del self.queue[:nbytes]
+			return data
+
+	def write(self, data):
+		with self.lock:
+			i = 0
+			while i < len(data):
+				length = data[i]
+				if length > 0:
+					self.queue += bytes(self.link.rx.transaction(list(data[i+1:i+1+length])))
+				i = i + 1 + length
+			return len(data)
+
+	def purge(self, mask=0):
+		with self.lock:
+			self.queue = bytearray()
+
+	def setBitMode(self, mask, enable):
+		pass
+
+	def setUSBParameters(self, in_size, out_size=0):
+		pass
+
+	def setTimeouts(self, read, write):
+		pass
+
+	def close(self):
+		pass
+
+
+def ramp_payload(clock):
+	#the test pattern the FPGA sends with no ADC attached: 4, 5 ... 63
+	return numpy.broadcast_to(numpy.arange(4, 64, dtype=numpy.uint8), clock.shape)
+
+def random_payload(clock, rng=numpy.random.default_rng()):
+	return rng.integers(0, 256, clock.shape, dtype=numpy.uint8)
+
+def image_payload(image, periodX=996, periodY=1000, phaseX=0., phaseY=0.):
+	#payload function that scans an image (2d uint8 array) the way the mirrors would, for testing reconstruction
+	import mini_uScope_reconstruction
+	height, width = image.shape
+	x = mini_uScope_reconstruction.mirror_positions(periodX, width, phaseX)
+	y = mini_uScope_reconstruction.mirror_positions(periodY, height, phaseY)
+	flat = numpy.ascontiguousarray(image, dtype=numpy.uint8).ravel()
+	return lambda clock: flat[y[clock % periodY]*width + x[clock % periodX]]
+
+
+class sim_link():
+	#drop_rate: fraction of packets lost.  bit_error_rate: chance of each bit being flipped.  slip_rate: fraction of
+	#packets cut short, which is what knocks the framer out of alignment.  byte_rate: bytes per second the reciever
+	#delivers while streaming (1.5 MB/s is about what the real link manages).  payload: function of the sample clocks,
+	#[npackets, 60] int64 -> uint8 values, e.g. ramp_payload, random_payload or image_payload(...).
+	#quality: optional function(tx_regs, rx_regs) -> (drop_rate, bit_error_rate, rssi, rnsi), called whenever a radio
+	#register changes, to make the impairments depend on the configuration like the real link does
+	def __init__(self, drop_rate=0., bit_error_rate=0., slip_rate=0., byte_rate=1.5e6, payload=ramp_payload, quality=None, clocks_per_packet=256, clocks_per_sample=2, seed=None):
+		self.drop_rate = drop_rate
+		self.bit_error_rate = bit_error_rate
+		self.slip_rate = slip_rate
+		self.byte_rate = byte_rate
+		self.payload = payload
+		self.quality = quality
+		self.clocks_per_packet = clocks_per_packet
+		self.clocks_per_sample = clocks_per_sample
+		self.rng = numpy.random.default_rng(seed)
+
+		self.tx = sim_radio(self)
+		self.rx = sim_radio(self)
+		self.tx_cfg = {0: 995, 1: 999} #transmitter FPGA config registers: mirror periods - 1
+		self.clock = 0 #transmitter clock count of the next packet
+		self.packets_sent = 0
+		self.packets_dropped = 0
+		self.bits_flipped = 0
+		self.lock = threading.Lock()
+
+	def spi_port(self, direction):
+		if direction == 'tx':
+			return sim_spi_port(self.tx, self.tx_cfg)
+		return sim_spi_port(self.rx)
+
+	def fifo_device(self, queue_size=2**20):
+		return sim_fifo_device(self, queue_size)
+
+	def config_changed(self):
+		if self.quality is None:
+			return
+		self.drop_rate, self.bit_error_rate, rssi, rnsi = self.quality(self.tx.regs, self.rx.regs)
+		self.rx.regs[0x22] = int(rssi) & 255
+		self.rx.regs[0x23] = int(rnsi) & 255
+
+	def corrupt(self, data):
+		#flips bits of a uint8 array in place, each with probability bit_error_rate
+		nflips = self.rng.binomial(data.size*8, self.bit_error_rate) if self.bit_error_rate > 0 else 0
+		if nflips > 0:
+			bits = self.rng.integers(0, data.size*8, nflips)
+			numpy.bitwise_xor.at(data.reshape(-1), bits//8, (1 << (bits % 8)).astype(numpy.uint8))
+		self.bits_flipped = self.bits_flipped + nflips
+
+	def deliver(self, radio, packet):
+		#a packet written into one radio's TX FIFO arrives at the other one, if it isn't dropped
+		if self.rng.random() < self.drop_rate:
+			self.packets_dropped = self.packets_dropped + 1
+			return
+		data = numpy.frombuffer(packet, dtype=numpy.uint8).copy()
+		self.corrupt(data)
+		(self.rx if radio is self.tx else self.tx).receive(data.tobytes())
+
+	def stream_packets(self, npackets):
+		#the next npackets the transmitter sends, as they arrive at the reciever: [n, 64] uint8 (before slips)
+		with self.lock:
+			periodX = self.tx_cfg.get(0, 995) + 1
+			periodY = self.tx_cfg.get(1, 999) + 1
+			clock = self.clock + self.clocks_per_packet*numpy.arange(npackets, dtype=numpy.int64)
+			self.clock = self.clock + self.clocks_per_packet*npackets
+			self.packets_sent = self.packets_sent + npackets
+
+			packets = numpy.zeros(npackets, dtype=mini_uScope_interfaces.packet_dtype)
+			packets['timerX'] = clock % periodX
+			packets['timerY'] = clock % periodY
+			sample_clock = clock[:, None] + self.clocks_per_sample*numpy.arange(mini_uScope_interfaces.payload_size)[None, :]
+			packets['payload'] = self.payload(sample_clock)
+			data = packets.view(numpy.uint8).reshape([npackets, mini_uScope_interfaces.packet_size])
+
+			keep = self.rng.random(npackets) >= self.drop_rate
+			self.packets_dropped = self.packets_dropped + npackets - int(numpy.count_nonzero(keep))
+			data = data[keep]
+			self.corrupt(data)
+			return data
+
+	def stream_bytes(self, npackets):
+		data = self.stream_packets(npackets)
+		if self.slip_rate <= 0 or len(data) == 0:
+			return data.tobytes()
+		#slipped packets lose their tail
+		slipped = numpy.flatnonzero(self.rng.random(len(data)) < self.slip_rate)
+		keep = numpy.ones(data.shape, dtype=bool)
+		lengths = self.rng.integers(1, mini_uScope_interfaces.packet_size, len(slipped))
+		keep[slipped] = numpy.arange(mini_uScope_interfaces.packet_size)[None, :] < lengths[:, None]
+		return data[keep].tobytes()
+
+
+def sim_session(link=None, verbose=False, **kwargs):
+	#a mini_uScope_interfaces.link_session, with fifo, running on a simulated link (made from kwargs if not given)
+	if link is None:
+		link = sim_link(**kwargs)
+	tx = mini_uScope_interfaces.rxtx_SPI('tx', verbose, slave=link.spi_port('tx'))
+	rx = mini_uScope_interfaces.rxtx_SPI('rx', verbose, slave=link.spi_port('rx'))
+	fifo = mini_uScope_interfaces.rx_FIFO(dev=link.fifo_device())
+	session = mini_uScope_interfaces.link_session(tx, rx, fifo, verbose)
+	session.link = link
+	return session
+
+
+#if run: stream a few seconds of simulated data through the framer and check how much arrived
+if __name__ == "__main__":
+	session = sim_session(drop_rate=0.01, bit_error_rate=1e-5)
+	session.config_UWB()
+	session.tx.set_mirror_periods(996, 1000)
+	print("mirror period registers:", session.tx.read_cfg_reg(0), session.tx.read_cfg_reg(1))
+	print("RX reg 0x3D:", session.fifo.read_reg(0x3D))
+	start = time.time()
+	data = session.fifo.read_data_time(2)
+	dt = time.time() - start
+	packets = mini_uScope_interfaces.frame_packets(data)
+	print("%i bytes in %.2f s (%.2f MB/s), %i packets framed; %i sent, %i dropped"%(len(data), dt, len(data)/dt/1e6, len(packets), session.link.packets_sent, session.link.packets_dropped))
+	session.close()
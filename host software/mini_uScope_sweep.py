@@ -0,0 +1,338 @@
+import time
+import json
+import hashlib
+import itertools
+import numpy
+import mini_uScope_results
+import mini_uScope_interfaces
+
+#============================================================
+#adaptive scheduling of RF parameter sweeps.
+#instead of capturing every (LNA, filter frequency, pulse frequency, pulse configuration) point for the same fixed
+#time, a sweep first covers a coarse grid of filter/pulse frequencies, then repeatedly refines around the points with
+#the lowest PER/BER, halving the step each time.  Pulse configurations are tried most pulses first, and once one is
+#dead at some frequency setting, the configurations that only use a subset of its pulses are skipped there, since
+#they transmit less energy into the same band.  capture() cuts short captures where the link is clearly down.
+
+def popcount(mask):
+	return bin(int(mask)).count('1')
+
+def capture(fifo, capture_time, expected_rate=0.75e6, min_fraction=0.5, check_time=0.05, poll_interval=0.001, estimator=None, settle_time=0.005):
+	#like rx_FIFO.read_data_time, but gives up as soon as the link is clearly dead: from check_time onwards, if less than
+	#min_fraction of expected_rate (bytes/s) has arrived.  Returns (data, aborted).
+	#with an estimator (mini_uScope_analysis.link_estimator), data is fed to it as it arrives, and the capture also
+	#ends as soon as the estimate is conclusive either way.
+	#call it straight after configuring the point: whatever is queued from before, and whatever arrives in the first
+	#settle_time seconds (packets already on their way under the previous configuration), is thrown away first, so it
+	#can't decide the new point
+	fifo.read_data()
+	settle_start = time.time()
+	while time.time() - settle_start < settle_time:
+		fifo.read_data()
+		time.sleep(poll_interval)
+	fifo.read_data()
+	chunks = []
+	nbytes = 0
+	start = time.time()
+	while True:
+		elapsed = time.time() - start
+		if elapsed >= capture_time:
+			return bytearray().join(chunks), False
+		if elapsed >= check_time and nbytes < min_fraction*expected_rate*elapsed:
+			return bytearray().join(chunks), True
+		chunk = fifo.read_data()
+		if len(chunk) == 0:
+			time.sleep(poll_interval)
+			continue
+		chunks.append(chunk)
+		nbytes = nbytes + len(chunk)
+		if estimator is not None and estimator.feed(chunk) != 'pending':
+			return bytearray().join(chunks), False
+
+
+class adaptive_sweep():
+	#measure(LNA_val, filt_val, pulse_freq, pulse_config) runs one point and returns a result dict with at least 'BER'
+	#and 'PER' (the same dicts mini_uScope_results.result_store takes).  run() is a generator of (point, result) in
+	#the order they are measured, where point is (LNA_val, filt_val, pulse_freq, pulse mask).
+	#max_BER/max_PER: what counts as a working link.  dead_PER: at or above this, a point is a failure for pruning.
+	#refine_top: how many of the best points each refinement pass looks around
+	def __init__(self, measure, LNA_vals=[4], filt_freqs=range(32), pulse_freqs=range(32), masks=range(1, 64), coarse_step=4, refine_top=4, max_BER=1e-3, max_PER=0.05, dead_PER=0.9):
+		self.measure = measure
+		self.LNA_vals = list(LNA_vals)
+		self.filt_freqs = list(filt_freqs)
+		self.pulse_freqs = list(pulse_freqs)
+		self.masks = sorted(masks, key=popcount, reverse=True) #most pulses first, so failures prune the most
+		self.coarse_step = coarse_step
+		self.refine_top = refine_top
+		self.max_BER = max_BER
+		self.max_PER = max_PER
+		self.dead_PER = dead_PER
+
+		self.results = {} #point -> result
+		self.failed = {} #(LNA_val, filt_val, pulse_freq) -> masks that were dead there
+		self.skipped = 0
+
+	def good(self, result):
+		return result['BER'] <= self.max_BER and result['PER'] <= self.max_PER
+
+	def dead(self, result):
+		return result['PER'] >= self.dead_PER
+
+	def score(self, result):
+		return (result['PER'], result['BER'])
+
+	def dominated(self, point):
+		#a configuration using only pulses of one that already failed at the same frequency setting
+		LNA_val, filt_val, pulse_freq, mask = point
+		for failed_mask in self.failed.get((LNA_val, filt_val, pulse_freq), []):
+			if mask & ~failed_mask == 0:
+				return True
+		return False
+
+	def coarse_points(self):
+		filts = self.filt_freqs[::self.coarse_step]
+		pulse_freqs = self.pulse_freqs[::self.coarse_step]
+		return [(LNA_val, filt_val, pulse_freq, mask) for LNA_val, filt_val, pulse_freq, mask in itertools.product(self.LNA_vals, filts, pulse_freqs, self.masks)]
+
+	def neighbours(self, point, step):
+		#grid points step apart in filter and pulse frequency around point, same LNA and pulse configuration
+		LNA_val, filt_val, pulse_freq, mask = point
+		i = self.filt_freqs.index(filt_val)
+		j = self.pulse_freqs.index(pulse_freq)
+		points = []
+		for di in [-step, 0, step]:
+			for dj in [-step, 0, step]:
+				if 0 <= i+di < len(self.filt_freqs) and 0 <= j+dj < len(self.pulse_freqs):
+					points.append((LNA_val, self.filt_freqs[i+di], self.pulse_freqs[j+dj], mask))
+		return points
+
+	def measure_point(self, point):
+		LNA_val, filt_val, pulse_freq, mask = point
+		result = self.measure(LNA_val, filt_val, pulse_freq, mini_uScope_results.pulse_list(mask))
+		self.results[point] = result
+		if self.dead(result):
+			self.failed.setdefault(point[:3], []).append(mask)
+		return result
+
+	def run(self):
+		queue = self.coarse_points()
+		step = self.coarse_step
+		while True:
+			for point in queue:
+				if point in self.results:
+					continue
+				if self.dominated(point):
+					self.skipped = self.skipped + 1
+					continue
+				yield point, self.measure_point(point)
+			if step <= 1:
+				break
+			step = max(step//2, 1)
+
+			#refine around every good point, and the best few even if nothing is good yet
+			ranked = sorted(self.results, key=lambda p: self.score(self.results[p]))
+			centres = ranked[:self.refine_top] + [p for p in ranked[self.refine_top:] if self.good(self.results[p])]
+			queue = []
+			for centre in centres:
+				queue.extend(self.neighbours(centre, step))
+
+	def best(self, n=1):
+		ranked = sorted(self.results, key=lambda p: self.score(self.results[p]))
+		return [(p, self.results[p]) for p in ranked[:n]]
+
+
+#============================================================
+#resumable sweeps.  Every measured point goes into a result store straight away, tagged with a hash of the point and
+#the sweep settings, so a sweep that dies part way (USB hiccup, exception in a read) picks up where it left off when
+#it is restarted: points already in the store with the same hash are returned from there instead of being measured.
+
+def config_hash(LNA_val, filt_val, pulse_freq, pulse_config, settings={}):
+	#64 bit hash of the config_UWB arguments plus anything else that changes the measurement (capture time, packet
+	#count...).  Never 0, which marks rows with no hash
+	if isinstance(pulse_config, (list, tuple)):
+		pulse_config = mini_uScope_results.pulse_mask(pulse_config)
+	config = {'LNA': int(LNA_val), 'filt_freq': int(filt_val), 'pulse_freq': int(pulse_freq), 'pulse_config': int(pulse_config)}
+	config['settings'] = settings
+	text = json.dumps(config, sort_keys=True)
+	h = int.from_bytes(hashlib.sha1(text.encode()).digest()[:8], 'little')
+	return h if h != 0 else 1
+
+def grid_points(LNA_vals, filt_freqs, pulse_freqs, masks):
+	#every combination, as (LNA_val, filt_val, pulse_freq, pulse mask) in nested loop order
+	return list(itertools.product(LNA_vals, filt_freqs, pulse_freqs, masks))
+
+
+class sweep_runner():
+	#wraps a measure(LNA_val, filt_val, pulse_freq, pulse_config) function with the same signature, so it can be used on
+	#its own (run) or handed to adaptive_sweep in place of measure.  settings: dict of whatever else defines the
+	#measurement; changing it starts the points over rather than reusing old results
+	def __init__(self, store, measure, settings={}):
+		self.store = store
+		self.measure = measure
+		self.settings = settings
+		self.resumed = 0 #points answered from the store
+		self.measured = 0
+		hashes = numpy.asarray(store.column('config_hash'))
+		self.done = {int(h): i for i, h in enumerate(hashes) if h != 0}
+
+	def completed(self, LNA_val, filt_val, pulse_freq, pulse_config):
+		return config_hash(LNA_val, filt_val, pulse_freq, pulse_config, self.settings) in self.done
+
+	def __call__(self, LNA_val, filt_val, pulse_freq, pulse_config):
+		h = config_hash(LNA_val, filt_val, pulse_freq, pulse_config, self.settings)
+		if h in self.done:
+			self.resumed = self.resumed + 1
+			return self.store.row(self.done[h])
+		result = dict(self.measure(LNA_val, filt_val, pulse_freq, pulse_config))
+		result['config_hash'] = h
+		self.store.append(result)
+		self.done[h] = len(self.store) - 1
+		self.measured = self.measured + 1
+		return result
+
+	def run(self, points):
+		#generator of (point, result) for points given as (LNA_val, filt_val, pulse_freq, pulse mask or list)
+		for point in points:
+			LNA_val, filt_val, pulse_freq, pulse_config = point
+			if not isinstance(pulse_config, (list, tuple)):
+				pulse_config = mini_uScope_results.pulse_list(pulse_config)
+			yield point, self(LNA_val, filt_val, pulse_freq, pulse_config)
+
+
+#============================================================
+#sweep plans.  A fixed set of points is put in the order that changes the fewest registers from one point to the next,
+#and the UWB transactions of every step are worked out up front (the same ones rxtx_SPI.config_UWB would send, via
+#config_regs and plan_reg_writes), so a plan can be saved as JSON, looked at, and replayed.
+#the order: grouped by tuning register value (0x0F = LNA*32+filt), then by pulse frequency (alternately up and down,
+#so crossing into the next tuning group keeps the pulse frequency), then pulse masks chained so each one is as close
+#as possible to the one before - starting from the mask the previous group ended on.  With every mask in the sweep
+#that is Gray code order, one pulse register per step; with a pruned set of masks it still finds the short steps.
+#	plan = sweep_plan(grid_points([4], range(23, 27), range(23, 27), range(1, 64)))
+#	for point in plan.replay(session): ...measure...
+
+def gray_rank(mask):
+	#position of mask in the binary reflected Gray code sequence (inverse Gray code)
+	rank = int(mask)
+	shift = rank >> 1
+	while shift:
+		rank = rank ^ shift
+		shift = shift >> 1
+	return rank
+
+def mask_distance(a, b):
+	#pulse registers a change of mask rewrites: from the first changed one to the last, which is about what a single
+	#burst write covers
+	changed = int(a) ^ int(b)
+	if changed == 0:
+		return 0
+	return changed.bit_length() - (changed & -changed).bit_length() + 1
+
+def chain_length(masks, start=None):
+	steps = zip([start] + masks[:-1], masks) if start is not None else zip(masks[:-1], masks[1:])
+	return sum(mask_distance(a, b) for a, b in steps)
+
+def order_masks(masks, start=None):
+	#Gray code order (forwards or backwards), or a greedy chain that always goes on to the nearest remaining mask
+	#(mask_distance, then fewest changed pulses), whichever is shorter from start.  Gray code order is one register per
+	#step when all the masks are there; the greedy chain does better on pruned sets
+	gray = sorted(set(masks), key=gray_rank)
+	remaining = list(gray)
+	ordered = []
+	current = start
+	while len(remaining) > 0:
+		if current is None:
+			next_mask = remaining[0]
+		else:
+			next_mask = min(remaining, key=lambda m: (mask_distance(current, m), popcount(current ^ m)))
+		remaining.remove(next_mask)
+		ordered.append(next_mask)
+		current = next_mask
+	return min([gray, gray[::-1], ordered], key=lambda chain: chain_length(chain, start))
+
+def plan_order(points):
+	#points (LNA_val, filt_val, pulse_freq, pulse mask) in change-minimising order; duplicates are dropped
+	groups = {}
+	for point in points:
+		LNA_val, filt_val, pulse_freq, mask = point
+		groups.setdefault(LNA_val*32+filt_val, {}).setdefault(pulse_freq, {})[mask] = point
+	ordered = []
+	flip = False
+	mask = None
+	for tuning in sorted(groups):
+		by_freq = groups[tuning]
+		for pulse_freq in sorted(by_freq, reverse=flip):
+			for mask in order_masks(by_freq[pulse_freq], mask):
+				ordered.append(by_freq[pulse_freq][mask])
+		flip = not flip
+	return ordered
+
+def transaction_bytes(transactions):
+	#SPI bytes of a list of UWB transactions, config byte included
+	return sum(len(payload) + 1 for payload in transactions)
+
+
+class sweep_plan():
+	#steps: one dict per point, in order: {'point': [LNA_val, filt_val, pulse_freq, mask], 'tx': [transactions],
+	#'rx': [transactions]}, each transaction a payload for rxtx_SPI.UWB_write.  The first step writes the full
+	#configuration; every later one only what differs from the step before.  order=False keeps the points as given
+	def __init__(self, points=[], order=True):
+		points = [tuple(int(x) for x in point) for point in points]
+		if order:
+			points = plan_order(points)
+		self.steps = []
+		shadows = {'tx': {}, 'rx': {}}
+		for point in points:
+			LNA_val, filt_val, pulse_freq, mask = point
+			step = {'point': list(point)}
+			for direction in ['tx', 'rx']:
+				wanted = mini_uScope_interfaces.config_regs(direction, LNA_val, filt_val, pulse_freq, mini_uScope_results.pulse_list(mask))
+				shadow = shadows[direction]
+				regs = {a: v for a, v in wanted.items() if a in mini_uScope_interfaces.volatile_regs or shadow.get(a) != v}
+				step[direction] = mini_uScope_interfaces.plan_reg_writes(regs, shadow)
+				shadow.update({a: v for a, v in wanted.items() if a not in mini_uScope_interfaces.volatile_regs})
+			self.steps.append(step)
+
+	def __len__(self):
+		return len(self.steps)
+
+	def points(self):
+		return [tuple(step['point']) for step in self.steps]
+
+	def cost(self):
+		#total SPI bytes of register traffic, per radio, not counting the first (full) configuration
+		return {direction: sum(transaction_bytes(step[direction]) for step in self.steps[1:]) for direction in ['tx', 'rx']}
+
+	def save(self, path):
+		with open(path, 'w') as f:
+			json.dump({'version': 1, 'cost': self.cost(), 'steps': self.steps}, f)
+
+	def replay(self, session):
+		#generator: configures session (mini_uScope_interfaces.link_session) for each point in turn, then yields the point
+		#for the caller to measure.  The first point goes through config_UWB, since the radios' registers may not be what
+		#the plan started from; from then on the precomputed transactions are sent as they are, and the register shadows
+		#are kept up to date so config_UWB and read_regs stay right afterwards
+		for i, step in enumerate(self.steps):
+			LNA_val, filt_val, pulse_freq, mask = step['point']
+			pulse_config = mini_uScope_results.pulse_list(mask)
+			if i == 0:
+				session.config_UWB(LNA_val, filt_val, pulse_freq, pulse_config)
+			else:
+				session.both(lambda: replay_step(session.tx, step['tx'], LNA_val, filt_val, pulse_freq, pulse_config),
+				             lambda: replay_step(session.rx, step['rx'], LNA_val, filt_val, pulse_freq, pulse_config))
+			yield tuple(step['point'])
+
+def replay_step(radio, transactions, LNA_val, filt_val, pulse_freq, pulse_config):
+	if len(transactions) > 0:
+		radio.set_config_byte(6)
+		for payload in transactions:
+			radio.UWB_write(payload)
+		radio.set_config_byte(1)
+	wanted = radio.config_regs(LNA_val, filt_val, pulse_freq, pulse_config)
+	radio.shadow.update({a: v for a, v in wanted.items() if a not in mini_uScope_interfaces.volatile_regs})
+
+def load_plan(path):
+	with open(path) as f:
+		saved = json.load(f)
+	plan = sweep_plan()
+	plan.steps = saved['steps']
+	return plan
@@ -65,17 +65,28 @@ class tx_m():
 		data = self.UWB_transaction(data)
 		return [int(x) for x in data]
 
-	def write_data(self, data):
-		#since the SPI in the FPGA has a tiny FIFO, break this into 8 byte chunks
-		i = 0
-		datas = []
-		while i<len(data): 
-			datas.append(data[i,min(i+8, len(data))])
-			i = i + 8
-
-		for data in datas:
-			data = [0x3F+64+128] + data
-			self.UWB_transaction(data)
+	def write_data(self, data, packet_length=64, start_tx=True, timeout=1.):
+		#streams data (bytes, bytearray, list of ints or uint8 numpy array) into the TX FIFO, packet_length bytes at a time.
+		#the SPI in the FPGA has a tiny FIFO, so it goes as 8 byte burst writes of register 0x3F, but those are write-only,
+		#and the TX FIFO usage (register 2, 128 bytes max) is only read back when the next packet might not fit.
+		#start_tx: send the start transmission command after each packet.  Call with UWB access on (config byte 6).
+		#raises TimeoutError if a packet still doesn't fit after timeout seconds
+		if packet_length > 128:
+			raise ValueError("packet_length %i doesn't fit in the 128 byte TX FIFO"%packet_length)
+		data = bytes(bytearray(data))
+		free = 0
+		for i in range(0, len(data), packet_length):
+			packet = data[i:i+packet_length]
+			deadline = time.time() + timeout
+			while free < len(packet):
+				free = 128 - self.read_reg(2)[-1]
+				if free < len(packet) and time.time() > deadline:
+					raise TimeoutError("TX FIFO still has only %i bytes free after %.1f s"%(free, timeout))
+			for j in range(0, len(packet), 8):
+				slave.write(bytearray([self.config_byte, 0x3F+64+128]) + packet[j:j+8])
+			if start_tx:
+				slave.write(bytearray([self.config_byte, 0x1F+64, 16]))
+			free = free - len(packet)
 
 
 	def config_UWB(self, LNA_val=4,filt_val=24,pulse_freq=25,pulse_config=[1,2,3,4,5]):
@@ -0,0 +1,166 @@
+import time
+import argparse
+import threading
+import numpy
+from matplotlib import pyplot as plt
+from matplotlib.animation import FuncAnimation
+import mini_uScope_interfaces
+import mini_uScope_reconstruction
+
+#============================================================
+#live image viewer.
+#acquisition and display run on different threads and only meet at a frame_buffer: the acquisition thread drains the
+#reciever's stream (rx_FIFO.start_stream, itself on its own reader thread), frames and bins the packets, and publishes
+#the newest image a few tens of times a second; the display picks up whatever is newest when it redraws.  A slow
+#display just skips frames, and never holds up the USB reader.  Drawing is blitted: only the image data and the
+#overlay text change between redraws, the axes are never redrawn.
+#	python mini_uScope_viewer.py          (reciever attached)
+#	python mini_uScope_viewer.py --sim    (simulated link scanning a test target)
+
+class frame_buffer():
+	#newest image and acquisition stats, shared between threads.  Publishing swaps in a new array rather than writing
+	#into the old one, so a reader holding the previous image is never looking at a half-written frame
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.image = None
+		self.stats = {}
+		self.version = 0
+
+	def publish(self, image, stats):
+		with self.lock:
+			self.image = image
+			self.stats = stats
+			self.version = self.version + 1
+
+	def latest(self):
+		with self.lock:
+			return self.version, self.image, self.stats
+
+
+class live_acquisition():
+	#stream -> framer -> reconstructor -> frame_buffer, on a thread of its own.
+	#stats published with each image: fps (completed frames per second), drop_rate (fraction of packets lost, from the
+	#header timers), backlog (bytes waiting in the host ring buffer) and ring_dropped (bytes lost to a full ring buffer)
+	def __init__(self, fifo, reconstructor, frames, publish_rate=30., stats_interval=1.):
+		self.fifo = fifo
+		self.reconstructor = reconstructor
+		self.frames = frames
+		self.publish_interval = 1./publish_rate
+		self.stats_interval = stats_interval
+		self.framer = mini_uScope_interfaces.packet_framer(reconstructor.periodX, reconstructor.periodY, reconstructor.clocks_per_packet)
+		self.running = False
+
+		self.counts = (reconstructor.received, reconstructor.lost) #the reconstructor's packet counts at the last stats update
+		self.stats = {'fps': 0., 'drop_rate': 0., 'backlog': 0, 'ring_dropped': 0}
+
+	def start(self, buffer_size=64*2**20):
+		self.stream = self.fifo.start_stream(buffer_size)
+		self.running = True
+		self.thread = threading.Thread(target=self.loop, daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.running = False
+		self.thread.join()
+		self.fifo.stop_stream()
+
+	def update_stats(self, elapsed, frames):
+		#lost packets come from the reconstructor, which has already run packet_gaps over everything it was fed
+		received = self.reconstructor.received - self.counts[0]
+		lost = self.reconstructor.lost - self.counts[1]
+		self.stats = {}
+		self.stats['fps'] = frames/elapsed
+		self.stats['drop_rate'] = lost/(received + lost) if received + lost > 0 else 0.
+		self.stats['backlog'] = self.stream.available()
+		self.stats['ring_dropped'] = self.stream.dropped
+		self.counts = (self.reconstructor.received, self.reconstructor.lost)
+
+	def loop(self):
+		last_publish = 0.
+		last_stats = time.time()
+		frames_at_last_stats = self.reconstructor.frames_done
+		while self.running:
+			if not self.stream.wait(mini_uScope_interfaces.packet_size, timeout=0.1):
+				continue
+			view = self.stream.peek()
+			packets = self.framer.feed(view) #the framer copies what it keeps, so the space can go straight back
+			self.stream.release(len(view))
+			if len(packets) == 0:
+				continue
+			done = self.reconstructor.feed(packets)
+
+			now = time.time()
+			if now - last_stats >= self.stats_interval:
+				self.update_stats(now - last_stats, self.reconstructor.frames_done - frames_at_last_stats)
+				last_stats = now
+				frames_at_last_stats = self.reconstructor.frames_done
+			if len(done) > 0:
+				self.frames.publish(done[-1], self.stats)
+				last_publish = now
+			elif now - last_publish >= self.publish_interval:
+				self.frames.publish(self.reconstructor.current_image(), self.stats) #frame still being filled in
+				last_publish = now
+
+
+class live_viewer():
+	def __init__(self, frames, width=256, height=256, interval=33, vmin=0, vmax=255):
+		self.frames = frames
+		self.interval = interval #ms between redraws
+		self.version = -1
+		self.last_redraw = time.time()
+		self.fig, self.ax = plt.subplots()
+		self.ax.set_axis_off()
+		self.im = self.ax.imshow(numpy.full([height, width], numpy.nan), cmap='gray', vmin=vmin, vmax=vmax, interpolation='nearest', animated=True)
+		self.overlay = self.ax.text(0.01, 0.99, '', transform=self.ax.transAxes, va='top', ha='left', color='yellow', family='monospace', animated=True)
+
+	def update(self, i):
+		version, image, stats = self.frames.latest()
+		if version != self.version and image is not None:
+			self.im.set_data(image)
+			self.version = version
+		now = time.time()
+		display_fps = 1./max(now - self.last_redraw, 1e-6)
+		self.last_redraw = now
+		text = "%.1f fps (display %.0f)\ndrops %.2f%%\nbacklog %.1f kB"%(stats.get('fps', 0.), display_fps, stats.get('drop_rate', 0.)*100, stats.get('backlog', 0)/1e3)
+		if stats.get('ring_dropped', 0) > 0:
+			text = text + "\nhost overrun %.1f kB"%(stats['ring_dropped']/1e3)
+		self.overlay.set_text(text)
+		return self.im, self.overlay
+
+	def show(self):
+		self.animation = FuncAnimation(self.fig, self.update, interval=self.interval, blit=True, cache_frame_data=False)
+		plt.show()
+
+
+def test_target(width=256, height=256):
+	#concentric rings, for the simulated link
+	y, x = numpy.mgrid[0:height, 0:width]
+	r = numpy.hypot(x - width/2, y - height/2)
+	return (127.5 + 127.5*numpy.cos(r/4)).astype(numpy.uint8)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="live image viewer")
+	parser.add_argument('--sim', action='store_true', help="use a simulated link instead of the reciever")
+	parser.add_argument('--width', type=int, default=256)
+	parser.add_argument('--height', type=int, default=256)
+	parser.add_argument('--periods', type=int, nargs=2, default=[996, 1000], help="mirror timer periods (periodX periodY)")
+	args = parser.parse_args()
+	periodX, periodY = args.periods
+
+	if args.sim:
+		import mini_uScope_simulator
+		payload = mini_uScope_simulator.image_payload(test_target(args.width, args.height), periodX, periodY)
+		link = mini_uScope_simulator.sim_link(drop_rate=0.01, bit_error_rate=1e-5, payload=payload)
+		link.tx_cfg[0] = periodX - 1
+		link.tx_cfg[1] = periodY - 1
+		fifo = mini_uScope_interfaces.rx_FIFO(dev=link.fifo_device())
+	else:
+		fifo = mini_uScope_interfaces.rx_FIFO()
+
+	frames = frame_buffer()
+	reconstructor = mini_uScope_reconstruction.image_reconstructor(periodX, periodY, args.width, args.height)
+	acquisition = live_acquisition(fifo, reconstructor, frames)
+	acquisition.start()
+	live_viewer(frames, args.width, args.height).show()
+	acquisition.stop()